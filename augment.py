@@ -0,0 +1,193 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Batched training augmentation run on the device, as an alternative to running
+timm's create_transform per image in the DataLoader workers.
+
+Workers only decode, resize to a fixed square canvas and apply AutoAugment if it is
+enabled (see build_worker_transform). DeviceAugment then applies, on the uint8 batch
+moved to the device, the rest of timm's transforms_imagenet_train with the same
+parameters: RandomResizedCrop, horizontal flip, color jitter, normalization and
+random erasing.
+"""
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+from torchvision import transforms
+
+from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+from timm.data.auto_augment import rand_augment_transform, augment_and_mix_transform, auto_augment_transform
+
+
+def canvas_size(input_size):
+    """Side of the square canvas decoded by the workers, the resize size used for evaluation."""
+    return int((256 / 224) * input_size)
+
+
+def build_worker_transform(args):
+    """Per-image part of the training transform when the rest runs on the device: resize the
+    shorter side, center crop a square canvas, AutoAugment if enabled, uint8 tensor.
+    """
+    assert args.input_size > 32, "device augmentation expects images larger than 32px"
+    size = canvas_size(args.input_size)
+    interpolation = Image.BILINEAR if args.train_interpolation == 'bilinear' else Image.BICUBIC
+    t = [transforms.Resize(size, interpolation=interpolation), transforms.CenterCrop(size)]
+    if args.aa and args.aa != 'none':
+        # same hparams as timm's transforms_imagenet_train, applied before the crop
+        aa_params = dict(
+            translate_const=int(args.input_size * 0.45),
+            img_mean=tuple([min(255, round(255 * x)) for x in IMAGENET_DEFAULT_MEAN]),
+        )
+        if args.train_interpolation and args.train_interpolation != 'random':
+            aa_params['interpolation'] = interpolation
+        if args.aa.startswith('rand'):
+            t.append(rand_augment_transform(args.aa, aa_params))
+        elif args.aa.startswith('augmix'):
+            aa_params['translate_pct'] = 0.3
+            t.append(augment_and_mix_transform(args.aa, aa_params))
+        else:
+            t.append(auto_augment_transform(args.aa, aa_params))
+    t.append(transforms.PILToTensor())
+    return transforms.Compose(t)
+
+
+def normalize(images, mean=IMAGENET_DEFAULT_MEAN, std=IMAGENET_DEFAULT_STD):
+    """ToTensor + Normalize for a uint8 batch already on the device."""
+    mean = torch.tensor(mean, device=images.device).view(1, -1, 1, 1) * 255
+    std = torch.tensor(std, device=images.device).view(1, -1, 1, 1) * 255
+    return (images.float() - mean) / std
+
+
+def _first_valid(valid, *values):
+    """Picks for each row the values of the first valid attempt, and whether there was one."""
+    first = valid.float().argmax(dim=1, keepdim=True)
+    return (valid.any(dim=1),) + tuple(v.gather(1, first).squeeze(1) for v in values)
+
+
+class DeviceAugment(nn.Module):
+    """RandomResizedCrop + horizontal flip + color jitter + normalize + random erasing on a batch.
+
+    Parameters follow timm's transforms_imagenet_train. The crop and flip are one affine
+    resampling per image, sampled with the same 10-attempt rule as torchvision. Color jitter
+    (brightness, contrast, saturation) is applied in a fixed order instead of a random one,
+    and is disabled when AutoAugment is used, as in timm.
+    """
+    def __init__(self, input_size=224, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), hflip=0.5,
+                 color_jitter=0.4, interpolation='bicubic', re_prob=0., re_mode='const', re_count=1,
+                 mean=IMAGENET_DEFAULT_MEAN, std=IMAGENET_DEFAULT_STD):
+        super().__init__()
+        self.input_size = input_size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.ratio = ratio
+        self.hflip = hflip
+        self.color_jitter = color_jitter or 0.
+        self.interpolation = interpolation if interpolation in ('bilinear', 'bicubic') else 'bilinear'
+        self.re_prob = re_prob
+        self.re_mode = re_mode
+        self.re_count = re_count
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1))
+
+    @classmethod
+    def from_args(cls, args):
+        use_aa = args.aa and args.aa != 'none'
+        return cls(
+            input_size=args.input_size,
+            color_jitter=None if use_aa else args.color_jitter,
+            interpolation=args.train_interpolation,
+            re_prob=args.reprob,
+            re_mode=args.remode,
+            re_count=args.recount,
+        )
+
+    @torch.no_grad()
+    def forward(self, images):
+        images = images.float() / 255.
+        images = self.resized_crop_flip(images)
+        if self.color_jitter > 0:
+            images = self.jitter(images)
+        images = (images - self.mean) / self.std
+        if self.re_prob > 0:
+            images = self.erase(images)
+        return images
+
+    def resized_crop_flip(self, images, attempts=10):
+        B, _, H, W = images.shape
+        device = images.device
+        area = H * W
+        target_area = area * torch.empty(B, attempts, device=device).uniform_(*self.scale)
+        aspect_ratio = torch.exp(torch.empty(B, attempts, device=device).uniform_(*self.log_ratio))
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+        found, w, h = _first_valid((w > 0) & (w <= W) & (h > 0) & (h <= H), w, h)
+
+        # fallback to a central crop, as in torchvision
+        in_ratio = W / H
+        if in_ratio < self.ratio[0]:
+            fallback_w, fallback_h = W, round(W / self.ratio[0])
+        elif in_ratio > self.ratio[1]:
+            fallback_w, fallback_h = round(H * self.ratio[1]), H
+        else:
+            fallback_w, fallback_h = W, H
+        w = torch.where(found, w, torch.full_like(w, fallback_w))
+        h = torch.where(found, h, torch.full_like(h, fallback_h))
+        top = torch.where(found, torch.rand(B, device=device) * (H - h + 1), (H - h) / 2).floor()
+        left = torch.where(found, torch.rand(B, device=device) * (W - w + 1), (W - w) / 2).floor()
+
+        # affine map from the output grid to the crop box, in normalized coordinates
+        flip = 1. - 2. * (torch.rand(B, device=device) < self.hflip).float()
+        theta = torch.zeros(B, 2, 3, device=device)
+        theta[:, 0, 0] = w / W * flip
+        theta[:, 0, 2] = (2 * left + w) / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = (2 * top + h) / H - 1
+        grid = F.affine_grid(theta, (B, 3, self.input_size, self.input_size), align_corners=False)
+        images = F.grid_sample(images, grid, mode=self.interpolation, padding_mode='border', align_corners=False)
+        return images.clamp(0, 1)
+
+    def jitter(self, images):
+        B = images.shape[0]
+        low, high = max(0., 1. - self.color_jitter), 1. + self.color_jitter
+        brightness, contrast, saturation = torch.empty(3, B, 1, 1, 1, device=images.device).uniform_(low, high)
+        images = (images * brightness).clamp(0, 1)
+        gray = (0.299 * images[:, 0] + 0.587 * images[:, 1] + 0.114 * images[:, 2]).unsqueeze(1)
+        images = (images * contrast + gray.mean(dim=(2, 3), keepdim=True) * (1 - contrast)).clamp(0, 1)
+        gray = (0.299 * images[:, 0] + 0.587 * images[:, 1] + 0.114 * images[:, 2]).unsqueeze(1)
+        images = (images * saturation + gray * (1 - saturation)).clamp(0, 1)
+        return images
+
+    def erase(self, images, min_area=0.02, max_area=1 / 3, min_aspect=0.3, attempts=10):
+        """timm RandomErasing on normalized images, per-image probability re_prob."""
+        B, C, H, W = images.shape
+        device = images.device
+        apply = torch.rand(B, device=device) < self.re_prob
+        rows = torch.arange(H, device=device).view(1, H, 1)
+        cols = torch.arange(W, device=device).view(1, 1, W)
+        log_aspect = (math.log(min_aspect), math.log(1 / min_aspect))
+        for _ in range(self.re_count):
+            target_area = H * W * torch.empty(B, attempts, device=device).uniform_(min_area, max_area) / self.re_count
+            aspect_ratio = torch.exp(torch.empty(B, attempts, device=device).uniform_(*log_aspect))
+            h = torch.sqrt(target_area * aspect_ratio).round()
+            w = torch.sqrt(target_area / aspect_ratio).round()
+            found, h, w = _first_valid((w < W) & (h < H), h, w)
+            top = (torch.rand(B, device=device) * (H - h + 1)).floor().view(B, 1, 1)
+            left = (torch.rand(B, device=device) * (W - w + 1)).floor().view(B, 1, 1)
+            mask = (rows >= top) & (rows < top + h.view(B, 1, 1)) & (cols >= left) & (cols < left + w.view(B, 1, 1))
+            mask = (mask & (apply & found).view(B, 1, 1)).unsqueeze(1)
+            if self.re_mode == 'pixel':
+                fill = torch.randn_like(images)
+            elif self.re_mode == 'rand':
+                fill = torch.randn(B, C, 1, 1, device=device)
+            else:
+                fill = torch.zeros(1, device=device)
+            images = torch.where(mask, fill, images)
+        return images
@@ -0,0 +1,298 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Micro-benchmarks and numerical checks for the ConViT layers.
+
+    python benchmark.py --bench attn --device cpu --models convit_tiny convit_small
+    python benchmark.py --bench loss --batch-size 256 --loss-batch-sizes 1024 4096 16384
+    python benchmark.py --bench gallery --gallery-size 1000000 --nlist 1024
+    python benchmark.py --bench compile --models convit_tiny --batch-size 64
+"""
+import argparse
+import contextlib
+import io
+import time
+import types
+
+import numpy as np
+import torch
+
+import models
+from timm.utils import NativeScaler
+
+from engine import train_one_epoch
+from gallery import ExactIndex, IVFIndex
+from losses import CustomContrastiveLoss
+import utils
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('ConViT benchmarks', add_help=False)
+    parser.add_argument('--bench', default='attn', choices=sorted(BENCHMARKS.keys()),
+                        help='Benchmark to run')
+    parser.add_argument('--models', default=['convit_tiny', 'convit_small', 'convit_base'], nargs='+',
+                        help='Models to benchmark')
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--input-size', default=224, type=int, help='images input size')
+    parser.add_argument('--embed_dim', default=48, type=int, help='embedding dimension per head')
+    parser.add_argument('--iters', default=10, type=int, help='timed iterations')
+    parser.add_argument('--warmup', default=2, type=int, help='untimed warmup iterations')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to benchmark on')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--loss-batch-sizes', default=[256, 1024, 4096], type=int, nargs='+',
+                        help='batch sizes for --bench loss')
+    parser.add_argument('--feature-dim', default=512, type=int, help='embedding size for --bench loss')
+    parser.add_argument('--identities', default=64, type=int, help='identities per batch for --bench loss')
+    parser.add_argument('--gallery-size', default=200000, type=int, help='gallery embeddings for --bench gallery')
+    parser.add_argument('--gallery-dim', default=128, type=int, help='embedding size for --bench gallery')
+    parser.add_argument('--queries', default=256, type=int, help='queries for --bench gallery')
+    parser.add_argument('--nlist', default=1024, type=int, help='inverted lists for --bench gallery')
+    return parser
+
+
+def create_model(name, args, **kwargs):
+    torch.manual_seed(args.seed)
+    model = getattr(models, name)(embed_dim=args.embed_dim, **kwargs)
+    return model.to(args.device)
+
+
+def timeit(fn, device, iters, warmup):
+    """Mean wall time of fn() in seconds."""
+    device = torch.device(device)
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters
+
+
+@torch.no_grad()
+def bench_attn(args):
+    """Checks that fused_attn=True matches the explicit attention maps and compares inference time."""
+    inputs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+    print('model          max abs diff   explicit (s)   fused (s)')
+    for name in args.models:
+        reference = create_model(name, args).eval()
+        fused = create_model(name, args, fused_attn=True).eval()
+        fused.load_state_dict(reference.state_dict())
+
+        diff = (reference(inputs) - fused(inputs)).abs().max().item()
+        t_ref = timeit(lambda: reference(inputs), args.device, args.iters, args.warmup)
+        t_fused = timeit(lambda: fused(inputs), args.device, args.iters, args.warmup)
+        print(f'{name:<14} {diff:<14.2e} {t_ref:<14.4f} {t_fused:.4f}')
+
+
+def peak_memory(fn, device):
+    """Peak memory in MB allocated on top of what is already live while running fn()."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    # on CPU, replay the allocations recorded by the profiler in chronological order
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    events = sorted(prof.function_events, key=lambda e: e.time_range.start)
+    running = peak = 0
+    for event in events:
+        running += event.self_cpu_memory_usage
+        peak = max(peak, running)
+    return peak / 2**20
+
+
+def legacy_gpsa_attention(self, x, grid_size=None):
+    """GPSA.get_attention as in the original ConViT code, kept as the reference for --bench gpsa.
+    grid_size is only passed on to get_rel_indices, the original code assumed a square grid.
+    """
+    B, N, C = x.shape
+    if self.rel_indices is None or self.rel_indices.size(1) != N:
+        self.get_rel_indices(N, grid_size)
+    qk = self.qk(x).reshape(B, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+    q, k = qk[0], qk[1]
+    pos_score = self.rel_indices.expand(B, -1, -1, -1)
+    pos_score = self.pos_proj(pos_score).permute(0, 3, 1, 2)
+    patch_score = (q @ k.transpose(-2, -1)) * self.scale
+    patch_score = patch_score.softmax(dim=-1)
+    pos_score = pos_score.softmax(dim=-1)
+
+    gating = self.gating_param.view(1, -1, 1, 1)
+    attn = (1. - torch.sigmoid(gating)) * patch_score + torch.sigmoid(gating) * pos_score
+    attn /= attn.sum(dim=-1).unsqueeze(-1)
+    attn = self.attn_drop(attn)
+    return attn
+
+
+def bench_gpsa(args):
+    """Peak memory and train step time of the GPSA attention before/after the leaner gating blend."""
+    inputs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=args.device)
+
+    def train_step(model):
+        model.zero_grad()
+        model(inputs).float().mean().backward()
+
+    print('model          impl     peak mem (MB)   step (s)')
+    for name in args.models:
+        model = create_model(name, args).train()
+        for impl in ('before', 'after'):
+            for blk in model.blocks:
+                if blk.use_gpsa:
+                    if impl == 'before':
+                        blk.attn.get_attention = types.MethodType(legacy_gpsa_attention, blk.attn)
+                    else:
+                        del blk.attn.get_attention
+            train_step(model)
+            mem = peak_memory(lambda: train_step(model), args.device)
+            step = timeit(lambda: train_step(model), args.device, args.iters, args.warmup)
+            print(f'{name:<14} {impl:<8} {mem:<15.1f} {step:.4f}')
+
+
+def legacy_contrastive_loss(feature_vectors, labels, margin):
+    """CustomContrastiveLoss.forward as in the original dense version, the reference for --bench loss."""
+    pairwise_distances = torch.cdist(feature_vectors, feature_vectors)
+    label_matrix = labels.view(-1, 1) == labels.view(1, -1)
+    positive_distances = pairwise_distances * label_matrix.float()
+    positive_loss = torch.sum(positive_distances) / (torch.sum(label_matrix) - len(labels))
+    negative_distances = pairwise_distances * (~label_matrix).float()
+    negative_loss = torch.sum(torch.clamp(margin - negative_distances, min=0)) / torch.sum(~label_matrix)
+    return positive_loss + negative_loss
+
+
+def bench_loss(args):
+    """Value, gradient and peak memory of the chunked contrastive loss against the dense one."""
+    criterion = CustomContrastiveLoss(margin=1., chunk_size=args.batch_size)
+    torch.manual_seed(args.seed)
+    print(f'chunk size {args.batch_size}')
+    print('batch    loss diff   grad diff   dense mem (MB)   chunked mem (MB)')
+    for batch_size in args.loss_batch_sizes:
+        features = torch.randn(batch_size, args.feature_dim, device=args.device, requires_grad=True)
+        labels = torch.randint(args.identities, (batch_size,), device=args.device)
+
+        def step(fn):
+            features.grad = None
+            loss = fn()
+            loss.backward()
+            return loss.detach()
+
+        dense = step(lambda: legacy_contrastive_loss(features, labels, 1.))
+        dense_grad = features.grad
+        chunked = step(lambda: criterion(features, labels))
+        loss_diff = (dense - chunked).abs().item()
+        grad_diff = (dense_grad - features.grad).abs().max().item()
+        dense_mem = peak_memory(lambda: step(lambda: legacy_contrastive_loss(features, labels, 1.)), args.device)
+        chunked_mem = peak_memory(lambda: step(lambda: criterion(features, labels)), args.device)
+        print(f'{batch_size:<8} {loss_diff:<11.2e} {grad_diff:<11.2e} {dense_mem:<16.1f} {chunked_mem:.1f}')
+
+
+def bench_gallery(args):
+    """Recall@10 against exact float32 search, latency and memory of the gallery indexes."""
+    rng = np.random.RandomState(args.seed)
+    # identities as clusters on the sphere, queries are other images of gallery identities
+    num_identities = max(args.gallery_size // 32, 1)
+    centers = rng.randn(num_identities, args.gallery_dim).astype(np.float32)
+    labels = rng.randint(num_identities, size=args.gallery_size)
+    gallery = centers[labels] + 0.7 * rng.randn(args.gallery_size, args.gallery_dim).astype(np.float32)
+    queries = centers[labels[:args.queries]] + 0.7 * rng.randn(args.queries, args.gallery_dim).astype(np.float32)
+    ids = np.arange(args.gallery_size)
+
+    reference = ExactIndex(args.gallery_dim, dtype='float32')
+    reference.add(gallery, ids)
+    _, truth = reference.search(queries, k=10)
+
+    ivf = {}
+    for dtype in ('float16', 'int8'):
+        ivf[dtype] = IVFIndex(args.gallery_dim, nlist=args.nlist, dtype=dtype)
+        ivf[dtype].train(gallery, seed=args.seed)
+        ivf[dtype].add(gallery, ids)
+    configs = [('exact', dtype, None) for dtype in ('float32', 'float16', 'int8')]
+    configs += [('ivf', dtype, nprobe) for dtype in ('float16', 'int8') for nprobe in (1, 4, 16, 64)]
+
+    print(f'{args.gallery_size} embeddings of dim {args.gallery_dim}, {args.queries} queries')
+    print('index    dtype     nprobe   recall@10   ms/query   storage (MB)')
+    for kind, dtype, nprobe in configs:
+        if kind == 'exact':
+            index = reference if dtype == 'float32' else ExactIndex(args.gallery_dim, dtype=dtype)
+            if index is not reference:
+                index.add(gallery, ids)
+            search = lambda: index.search(queries, k=10)
+        else:
+            index = ivf[dtype]
+            search = lambda: index.search(queries, k=10, nprobe=nprobe)
+        _, found = search()
+        recall = np.mean([len(np.intersect1d(f, t)) / 10 for f, t in zip(found, truth)])
+        latency = timeit(search, 'cpu', 1, 0) / args.queries * 1000
+        storage = (index.vectors[:index.ntotal].nbytes + index.scales[:index.ntotal].nbytes) / 2**20
+        print(f'{kind:<8} {dtype:<9} {str(nprobe or "-"):<8} {recall:<11.3f} {latency:<10.3f} {storage:.1f}')
+
+
+def bench_sync(args):
+    """Training steps per second of train_one_epoch with and without deferred_sync."""
+    batches = [(torch.randn(args.batch_size, 3, args.input_size, args.input_size),
+                torch.randint(1000, (args.batch_size,))) for _ in range(args.iters)]
+    criterion = torch.nn.CrossEntropyLoss()
+    print('model          mode       steps/s')
+    for name in args.models:
+        model = create_model(name, args)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+        loss_scaler = NativeScaler()
+        for deferred_sync in (False, True):
+            def epoch():
+                # the MetricLogger output is not part of the benchmark
+                with contextlib.redirect_stdout(io.StringIO()):
+                    train_one_epoch(model, criterion, batches, optimizer, torch.device(args.device), 0,
+                                    loss_scaler, deferred_sync=deferred_sync)
+            step = timeit(epoch, args.device, 1, 1) / len(batches)
+            print(f'{name:<14} {"deferred" if deferred_sync else "eager":<10} {1 / step:.2f}')
+
+
+def bench_compile(args):
+    """Training steps per second of train_one_epoch on the eager and the torch.compile'd model.
+    The first compiled epoch, which includes the compilation, is reported separately.
+    """
+    batches = [(torch.randn(args.batch_size, 3, args.input_size, args.input_size),
+                torch.randint(1000, (args.batch_size,))) for _ in range(args.iters)]
+    criterion = torch.nn.CrossEntropyLoss()
+    print('model          mode       first epoch (s)  steps/s')
+    for name in args.models:
+        model = create_model(name, args)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+        loss_scaler = NativeScaler()
+        for compiled in (False, True):
+            train_model = utils.compile_model(model) if compiled else model
+
+            def epoch():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    train_one_epoch(train_model, criterion, batches, optimizer, torch.device(args.device), 0,
+                                    loss_scaler)
+            first = timeit(epoch, args.device, 1, 0)
+            step = timeit(epoch, args.device, 1, 0) / len(batches)
+            print(f'{name:<14} {"compiled" if compiled else "eager":<10} {first:<16.2f} {1 / step:.2f}')
+
+
+BENCHMARKS = {
+    'attn': bench_attn,
+    'compile': bench_compile,
+    'gallery': bench_gallery,
+    'gpsa': bench_gpsa,
+    'loss': bench_loss,
+    'sync': bench_sync,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('ConViT benchmarks', parents=[get_args_parser()])
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](args)
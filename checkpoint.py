@@ -0,0 +1,271 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Checkpoint writing off the training loop, and a sharded checkpoint format.
+
+A sharded checkpoint is a small JSON manifest (at the usual checkpoint.pth path) listing,
+for each top-level entry of the state ('model', 'optimizer', 'model_ema', ...), a pickled
+skeleton with the tensors taken out, and for each tensor a raw data blob. Skeletons and
+blobs are content-addressed files in a data directory shared by the checkpoints of a run,
+so a tensor that did not change since the previous save (optimizer state of frozen
+parameters, step counters, buffers, ...) is not written again. load_checkpoint reads a
+section only when it is accessed, with its tensors memory-mapped.
+"""
+import collections.abc
+import copy
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import re
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+import utils
+
+SHARDED_FORMAT = 'sharded-checkpoint-v1'
+
+# the checkpoints hold the argparse.Namespace of the run, which torch>=2.6 refuses to unpickle by default
+_LOAD_KWARGS = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+
+
+def snapshot(obj):
+    """Copy of a (nested) state dict with every tensor copied to the CPU, so that training can
+    go on modifying the parameters while the copy is written.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints from a background thread, on the main process only.
+
+    save() snapshots the state on the calling thread and returns, the file is written as
+    path.tmp and renamed to path once complete, so a crash never leaves a truncated
+    checkpoint. The periodic copies are hard links to the same file (a copy on filesystems
+    without hard links) instead of being serialized again, and only the keep most recent
+    checkpoint_<epoch>.pth files are kept when keep is set. One write is in flight at a
+    time: save() and wait() wait for the previous one and re-raise its error, if any.
+    """
+    periodic_pattern = re.compile(r'^checkpoint_(\d+)\.pth$')
+
+    def __init__(self, keep=None, save_fn=torch.save):
+        if keep is not None and keep < 1:
+            raise ValueError("keep={} would delete the checkpoint just written, it must be at least 1".format(keep))
+        self.keep = keep
+        self.save_fn = save_fn
+        self.sharded = save_fn is save_sharded
+        self._thread = None
+        self._error = None
+
+    def save(self, state, path, copies=()):
+        if not utils.is_main_process():
+            return
+        state = snapshot(state)
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state, str(path), [str(c) for c in copies]))
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, state, path, copies):
+        try:
+            tmp_path = path + '.tmp'
+            self.save_fn(state, tmp_path)
+            os.replace(tmp_path, path)
+            for copy_path in copies:
+                # the link survives the next os.replace of path, which creates a new file
+                try:
+                    os.link(path, copy_path + '.tmp')
+                except OSError:
+                    shutil.copyfile(path, copy_path + '.tmp')
+                os.replace(copy_path + '.tmp', copy_path)
+            if self.keep is not None:
+                self.prune(os.path.dirname(path))
+            if self.sharded:
+                collect_garbage(os.path.dirname(path))
+        except BaseException as e:
+            self._error = e
+
+    def prune(self, directory):
+        """Removes all but the keep most recent checkpoint_<epoch>.pth files of directory."""
+        epochs = []
+        for name in os.listdir(directory):
+            match = self.periodic_pattern.match(name)
+            if match:
+                epochs.append((int(match.group(1)), name))
+        for _, name in sorted(epochs)[:max(len(epochs) - self.keep, 0)]:
+            os.remove(os.path.join(directory, name))
+
+
+class _TensorRef(object):
+    """Placeholder of the i-th tensor of a section in its pickled skeleton."""
+    def __init__(self, index):
+        self.index = index
+
+
+def _split_tensors(obj, tensors):
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return _TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        return type(obj)((k, _split_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _join_tensors(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return type(obj)((k, _join_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_join_tensors(v, tensors) for v in obj)
+    return obj
+
+
+# dtypes numpy does not have, stored as a same-width integer view
+_NUMPY_VIEWS = {getattr(torch, name): torch.int8 if name.startswith('float8') else torch.int16
+                for name in ('bfloat16', 'float8_e4m3fn', 'float8_e5m2') if hasattr(torch, name)}
+
+
+def _write_blob(data_dir, data, suffix):
+    """Writes data as <sha1><suffix> in data_dir unless it is already there, returns the name."""
+    name = hashlib.sha1(data).hexdigest() + suffix
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    return name
+
+
+def save_sharded(state, path, data_dir=None):
+    """Saves a checkpoint dict in the sharded format, the blobs going to data_dir (default:
+    checkpoint_data next to path). Drop-in replacement of torch.save(state, path).
+    """
+    path = str(path)
+    if data_dir is None:
+        data_dir = os.path.join(os.path.dirname(path), 'checkpoint_data')
+    os.makedirs(data_dir, exist_ok=True)
+    sections = {}
+    for name, value in state.items():
+        tensors = []
+        skeleton = _split_tensors(value, tensors)
+        entries = []
+        for tensor in tensors:
+            tensor = tensor.detach().cpu().contiguous()
+            entry = {}
+            if tensor.dtype in _NUMPY_VIEWS:
+                entry['torch_dtype'] = str(tensor.dtype).replace('torch.', '')
+                tensor = tensor.view(_NUMPY_VIEWS[tensor.dtype])
+            array = tensor.numpy()
+            entry.update(blob=_write_blob(data_dir, memoryview(array.reshape(-1)).cast('B'), '.bin'),
+                         dtype=array.dtype.str, shape=list(array.shape))
+            entries.append(entry)
+        sections[name] = dict(skeleton=_write_blob(data_dir, pickle.dumps(skeleton), '.pkl'), tensors=entries)
+    manifest = dict(format=SHARDED_FORMAT, data_dir=os.path.relpath(data_dir, os.path.dirname(path) or '.'),
+                    sections=sections)
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def _read_manifest(path):
+    """The manifest of a sharded checkpoint, None for any other file."""
+    with open(path, 'rb') as f:
+        head = f.read(64)
+    if not head.startswith(b'{'):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    return manifest if manifest.get('format') == SHARDED_FORMAT else None
+
+
+class ShardedCheckpoint(collections.abc.Mapping):
+    """Read-only view of a sharded checkpoint that loads each section on first access. The
+    tensors are memory-mapped copy-on-write, only the pages that are read are loaded.
+    """
+    def __init__(self, path, manifest):
+        self.path = path
+        self.data_dir = os.path.join(os.path.dirname(path), manifest['data_dir'])
+        self.sections = manifest['sections']
+        self._loaded = {}
+
+    def _load_tensor(self, entry):
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        path = os.path.join(self.data_dir, entry['blob'])
+        if int(np.prod(shape)) == 0:
+            tensor = torch.from_numpy(np.zeros(shape, dtype=dtype))
+        else:
+            tensor = torch.from_numpy(np.memmap(path, dtype=dtype, mode='c', shape=shape))
+        if 'torch_dtype' in entry:
+            tensor = tensor.view(getattr(torch, entry['torch_dtype']))
+        return tensor
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            section = self.sections[name]
+            with open(os.path.join(self.data_dir, section['skeleton']), 'rb') as f:
+                skeleton = pickle.load(f)
+            tensors = [self._load_tensor(entry) for entry in section['tensors']]
+            self._loaded[name] = _join_tensors(skeleton, tensors)
+        return self._loaded[name]
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """Loads a checkpoint saved by torch.save or save_sharded. Sharded checkpoints are
+    returned as a lazy ShardedCheckpoint mapping, on the CPU.
+    """
+    manifest = _read_manifest(path)
+    if manifest is None:
+        return torch.load(path, map_location=map_location, **_LOAD_KWARGS)
+    return ShardedCheckpoint(str(path), manifest)
+
+
+def collect_garbage(directory, data_dir='checkpoint_data'):
+    """Removes the blobs of data_dir not referenced by any sharded checkpoint of directory."""
+    data_dir = os.path.join(directory, data_dir)
+    if not os.path.isdir(data_dir):
+        return
+    referenced = set()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or not name.endswith('.pth'):
+            continue
+        manifest = _read_manifest(path)
+        if manifest is None:
+            continue
+        for section in manifest['sections'].values():
+            referenced.add(section['skeleton'])
+            referenced.update(entry['blob'] for entry in section['tensors'])
+    for name in os.listdir(data_dir):
+        if name not in referenced and not name.endswith('.tmp'):
+            os.remove(os.path.join(data_dir, name))
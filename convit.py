@@ -13,6 +13,8 @@ import torch
 import torch.nn as nn
 from functools import partial
 import torch.nn.functional as F
+import inspect
+from torch.utils.checkpoint import checkpoint
 from timm.models.helpers import load_pretrained
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
@@ -20,6 +22,65 @@ from timm.models.registry import register_model
 import torch
 import torch.nn as nn
 import matplotlib.pyplot as plt
+from collections import OrderedDict
+
+
+# Relative position tables are identical for every GPSA layer of a given patch grid,
+# so they are built once per (grid, device) and shared between layers.
+_REL_INDICES_CACHE = OrderedDict()
+REL_INDICES_CACHE_SIZE = 8
+
+
+def get_rel_indices(num_patches, device=None, grid_size=None):
+    """Returns the 1 x N x N x 3 table of (dx, dy, dx**2 + dy**2) between patches,
+    taken from a module-level LRU cache shared by all GPSA layers.
+    grid_size is the (rows, cols) layout of the patches, a square grid by default.
+    """
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    if grid_size is None:
+        img_size = int(num_patches**.5)
+        grid_size = (img_size, img_size)
+    grid_size = tuple(grid_size)
+    key = (num_patches, grid_size, device)
+    if key in _REL_INDICES_CACHE:
+        _REL_INDICES_CACHE.move_to_end(key)
+        return _REL_INDICES_CACHE[key]
+
+    width = grid_size[1]
+    coords = torch.arange(num_patches, device=device)
+    indx = (coords % width).view(1, -1) - (coords % width).view(-1, 1)
+    indy = (coords // width).view(1, -1) - (coords // width).view(-1, 1)
+    indd = indx**2 + indy**2
+    rel_indices = torch.stack((indx, indy, indd), dim=-1).unsqueeze(0).float()
+
+    _REL_INDICES_CACHE[key] = rel_indices
+    while len(_REL_INDICES_CACHE) > REL_INDICES_CACHE_SIZE:
+        _REL_INDICES_CACHE.popitem(last=False)
+    return rel_indices
+
+
+def _is_compiling():
+    """Whether torch.compile is tracing the current call, the data_ptr-keyed caches are skipped then."""
+    dynamo = getattr(torch, '_dynamo', None)
+    return dynamo is not None and hasattr(dynamo, 'is_compiling') and dynamo.is_compiling()
+
+
+# non-reentrant checkpointing when this torch version has it, it does not warn nor require grad on inputs
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def fused_attention(q, k, v, scale, dropout_p=0.):
+    """softmax(q @ k^T * scale) @ v without materializing the attention matrix when
+    torch.nn.functional.scaled_dot_product_attention is available (torch>=2.0, CPU and CUDA).
+    """
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        attn = ((q @ k.transpose(-2, -1)) * scale).softmax(dim=-1)
+        return F.dropout(attn, p=dropout_p) @ v
+    # scaled_dot_product_attention always scales by head_dim ** -0.5, fold any other qk_scale into q
+    default_scale = q.size(-1) ** -0.5
+    if scale != default_scale:
+        q = q * (scale / default_scale)
+    return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
 
 
 class Mlp(nn.Module):
@@ -53,7 +114,7 @@ class Mlp(nn.Module):
 
 class GPSA(nn.Module):
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.,
-                 locality_strength=1., use_local_init=True):
+                 locality_strength=1., use_local_init=True, cache_pos_attn=True, fused_attn=False):
         super().__init__()
         self.num_heads = num_heads
         self.dim = dim
@@ -69,6 +130,12 @@ class GPSA(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.locality_strength = locality_strength
         self.gating_param = nn.Parameter(torch.ones(self.num_heads))
+        self.rel_indices = None
+        self.rel_grid_size = None
+        # gated positional attention kept between forwards in eval mode, see get_pos_attention
+        self.cache_pos_attn = cache_pos_attn
+        self._pos_attn_cache = None
+        self.fused_attn = fused_attn
         self.apply(self._init_weights)
         if use_local_init:
             self.local_init(locality_strength=locality_strength)
@@ -82,37 +149,80 @@ class GPSA(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
         
-    def forward(self, x):
+    def forward(self, x, grid_size=None):
         B, N, C = x.shape
-        if not hasattr(self, 'rel_indices') or self.rel_indices.size(1)!=N:
-            self.get_rel_indices(N)
-
-        attn = self.get_attention(x)
         v = self.v(x).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        # the blend cannot be split in two when dropout is applied on the mixed map
+        if self.fused_attn and not (self.training and self.attn_drop.p > 0):
+            x = self.get_fused_output(x, v, grid_size)
+        else:
+            attn = self.get_attention(x, grid_size)
+            x = attn @ v
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
-    def get_attention(self, x):
+    def get_attention(self, x, grid_size=None):
         B, N, C = x.shape        
         qk = self.qk(x).reshape(B, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k = qk[0], qk[1]
-        pos_score = self.rel_indices.expand(B, -1, -1,-1)
-        pos_score = self.pos_proj(pos_score).permute(0,3,1,2) 
-        patch_score = (q @ k.transpose(-2, -1)) * self.scale
+        patch_score = (q * self.scale) @ k.transpose(-2, -1)
         patch_score = patch_score.softmax(dim=-1)
-        pos_score = pos_score.softmax(dim=-1)
+        pos_attn = self.get_pos_attention(N, x.device, grid_size)
 
-        gating = self.gating_param.view(1,-1,1,1)
-        attn = (1.-torch.sigmoid(gating)) * patch_score + torch.sigmoid(gating) * pos_score
-        attn /= attn.sum(dim=-1).unsqueeze(-1)
+        # a convex mix of two softmaxes already sums to one, no renormalization needed
+        gating = torch.sigmoid(self.gating_param).view(1,-1,1,1)
+        attn = torch.addcmul(pos_attn, patch_score, 1.-gating)
         attn = self.attn_drop(attn)
         return attn
 
-    def get_attention_map(self, x, return_map = False):
+    def get_fused_output(self, x, v, grid_size=None):
+        """Same as get_attention(x) @ v, using that the blend of the two softmaxes is linear:
+        the patch term goes through fused_attention and the positional term is a single
+        1 x H x N x N map shared by the batch, so no B x H x N x N map is materialized.
+        """
+        B, N, C = x.shape
+        qk = self.qk(x).reshape(B, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k = qk[0], qk[1]
+        patch_out = fused_attention(q, k, v, self.scale)
+        pos_attn = self.get_pos_attention(N, x.device, grid_size)
+
+        gating = torch.sigmoid(self.gating_param).view(1,-1,1,1)
+        return torch.addcmul(pos_attn @ v, patch_out, 1.-gating)
+
+    def get_pos_attention(self, N, device, grid_size=None):
+        """Gated positional attention sigmoid(gating) * softmax(pos_proj(rel_indices)), of shape
+        1 x H x N x N. It does not depend on the input, so it is computed once per forward and
+        broadcast over the batch. In eval mode without autograd it is also kept between forwards
+        until pos_proj or gating_param are modified.
+        """
+        # None is the square grid, normalized so that the stored grid compares equal either way
+        grid_size = tuple(grid_size) if grid_size is not None else (int(N**.5),) * 2
+        if self.rel_indices is None or self.rel_indices.size(1)!=N or self.rel_indices.device!=device \
+                or self.rel_grid_size!=grid_size:
+            self.get_rel_indices(N, grid_size)
+        use_cache = self.cache_pos_attn and not self.training and not torch.is_grad_enabled() and not _is_compiling()
+        if use_cache:
+            params = (self.pos_proj.weight, self.pos_proj.bias, self.gating_param)
+            key = (self.rel_indices.data_ptr(),) + tuple((p.data_ptr(), p._version) for p in params)
+            if self._pos_attn_cache is not None and self._pos_attn_cache[0] == key:
+                return self._pos_attn_cache[1]
+
+        pos_score = self.pos_proj(self.rel_indices).permute(0,3,1,2)
+        pos_score = pos_score.softmax(dim=-1)
+        gating = torch.sigmoid(self.gating_param).view(1,-1,1,1)
+        pos_attn = gating * pos_score
 
-        attn_map = self.get_attention(x).mean(0) # average over batch
+        if use_cache:
+            self._pos_attn_cache = (key, pos_attn)
+        else:
+            self._pos_attn_cache = None
+        return pos_attn
+
+    def get_attention_map(self, x, return_map = False, grid_size=None):
+
+        attn_map = self.get_attention(x, grid_size).mean(0) # average over batch
         distances = self.rel_indices.squeeze()[:,:,-1]**.5
         dist = torch.einsum('nm,hnm->h', (distances, attn_map))
         dist /= distances.size(0)
@@ -136,26 +246,21 @@ class GPSA(nn.Module):
                 self.pos_proj.weight.data[position,0] = 2*(h2-center)*locality_distance
         self.pos_proj.weight.data *= locality_strength
 
-    def get_rel_indices(self, num_patches):
-        img_size = int(num_patches**.5)
-        rel_indices   = torch.zeros(1, num_patches, num_patches, 3)
-        ind = torch.arange(img_size).view(1,-1) - torch.arange(img_size).view(-1, 1)
-        indx = ind.repeat(img_size,img_size)
-        indy = ind.repeat_interleave(img_size,dim=0).repeat_interleave(img_size,dim=1)
-        indd = indx**2 + indy**2
-        rel_indices[:,:,:,2] = indd.unsqueeze(0)
-        rel_indices[:,:,:,1] = indy.unsqueeze(0)
-        rel_indices[:,:,:,0] = indx.unsqueeze(0)
-        device = self.qk.weight.device
-        self.rel_indices = rel_indices.to(device)
+    def get_rel_indices(self, num_patches, grid_size=None):
+        # shared with the other GPSA layers, see get_rel_indices at module level
+        grid_size = tuple(grid_size) if grid_size is not None else (int(num_patches**.5),) * 2
+        self.rel_indices = get_rel_indices(num_patches, self.qk.weight.device, grid_size)
+        self.rel_grid_size = grid_size
 
  
 class MHSA(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 fused_attn=False):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.fused_attn = fused_attn
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -179,13 +284,7 @@ class MHSA(nn.Module):
         attn_map = (q @ k.transpose(-2, -1)) * self.scale
         attn_map = attn_map.softmax(dim=-1).mean(0)
 
-        img_size = int(N**.5)
-        ind = torch.arange(img_size).view(1,-1) - torch.arange(img_size).view(-1, 1)
-        indx = ind.repeat(img_size,img_size)
-        indy = ind.repeat_interleave(img_size,dim=0).repeat_interleave(img_size,dim=1)
-        indd = indx**2 + indy**2
-        distances = indd**.5
-        distances = distances.to('cuda')
+        distances = get_rel_indices(N, x.device)[0, :, :, -1]**.5
 
         dist = torch.einsum('nm,hnm->h', (distances, attn_map))
         dist /= N
@@ -201,11 +300,16 @@ class MHSA(nn.Module):
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused_attn:
+            dropout_p = self.attn_drop.p if self.training else 0.
+            x = fused_attention(q, k, v, self.scale, dropout_p=dropout_p)
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -213,21 +317,24 @@ class MHSA(nn.Module):
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads,  mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, use_gpsa=True, **kwargs):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, use_gpsa=True, fused_attn=False, **kwargs):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.use_gpsa = use_gpsa
         if self.use_gpsa:
-            self.attn = GPSA(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, **kwargs)
+            self.attn = GPSA(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, fused_attn=fused_attn, **kwargs)
         else:
-            self.attn = MHSA(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, **kwargs)
+            self.attn = MHSA(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, fused_attn=fused_attn, **kwargs)
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x):
-        x = x + self.drop_path(self.attn(self.norm1(x)))
+    def forward(self, x, grid_size=None):
+        if self.use_gpsa:
+            x = x + self.drop_path(self.attn(self.norm1(x), grid_size))
+        else:
+            x = x + self.drop_path(self.attn(self.norm1(x)))
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
     
@@ -242,14 +349,15 @@ class PatchEmbed(nn.Module):
         num_patches = (img_size[1] // patch_size[1]) * (img_size[0] // patch_size[0])
         self.img_size = img_size
         self.patch_size = patch_size
+        self.grid_size = (img_size[0] // patch_size[0], img_size[1] // patch_size[1])
         self.num_patches = num_patches
 
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
         self.apply(self._init_weights)
     def forward(self, x):
         B, C, H, W = x.shape
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        assert H % self.patch_size[0] == 0 and W % self.patch_size[1] == 0, \
+            f"Input image size ({H}*{W}) is not a multiple of the patch size ({self.patch_size[0]}*{self.patch_size[1]})."
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
     def _init_weights(self, m):
@@ -300,7 +408,8 @@ class VisionTransformer(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=48, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., hybrid_backbone=None, norm_layer=nn.LayerNorm, global_pool=None,
-                 local_up_to_layer=10, locality_strength=1., use_pos_embed=True):
+                 local_up_to_layer=10, locality_strength=1., use_pos_embed=True, fused_attn=False,
+                 grad_checkpoint=None):
         super().__init__()
         self.num_classes = num_classes
         self.local_up_to_layer = local_up_to_layer
@@ -323,19 +432,21 @@ class VisionTransformer(nn.Module):
         if self.use_pos_embed:
             self.pos_embed = nn.Parameter(torch.zeros(1, num_patches, embed_dim))
             trunc_normal_(self.pos_embed, std=.02)
+        # pos_embed interpolated to other resolutions in eval mode, see get_pos_embed
+        self._pos_embed_cache = {}
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
-                use_gpsa=True,
+                use_gpsa=True, fused_attn=fused_attn,
                 locality_strength=locality_strength)
             if i<local_up_to_layer else
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
-                use_gpsa=False)
+                use_gpsa=False, fused_attn=fused_attn)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -345,6 +456,7 @@ class VisionTransformer(nn.Module):
 
         trunc_normal_(self.cls_token, std=.02)
         self.head.apply(self._init_weights)
+        self.set_grad_checkpointing(grad_checkpoint)
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -366,20 +478,81 @@ class VisionTransformer(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
+    def set_grad_checkpointing(self, policy=None):
+        """Selects the blocks whose activations are recomputed in backward instead of stored:
+        None or 'none', 'all', 'gpsa', 'mhsa', or an integer k for every k-th block.
+        """
+        if policy is None or policy == 'none':
+            selected = [False for blk in self.blocks]
+        elif policy == 'all':
+            selected = [True for blk in self.blocks]
+        elif policy == 'gpsa':
+            selected = [blk.use_gpsa for blk in self.blocks]
+        elif policy == 'mhsa':
+            selected = [not blk.use_gpsa for blk in self.blocks]
+        elif str(policy).isdigit() and int(policy) > 0:
+            selected = [u % int(policy) == 0 for u in range(len(self.blocks))]
+        else:
+            raise ValueError(f"Unknown grad checkpointing policy {policy}, expected none, all, gpsa, mhsa or an integer")
+        self.grad_checkpoint = selected
+
+    def build_rel_indices(self, grid_size=None):
+        """Builds the rel_indices of every GPSA layer for a grid_size patch grid (the training
+        grid by default) ahead of the first forward, e.g. before torch.compile so that the
+        compiled graph never takes the rebuild branch of get_pos_attention.
+        """
+        if grid_size is None and isinstance(self.patch_embed, PatchEmbed):
+            grid_size = self.patch_embed.grid_size
+        num_patches = self.patch_embed.num_patches if grid_size is None else grid_size[0] * grid_size[1]
+        for blk in self.blocks:
+            if isinstance(blk.attn, GPSA):
+                blk.attn.get_rel_indices(num_patches, grid_size)
+
+    def get_pos_embed(self, grid_size):
+        """pos_embed for a grid_size (rows, cols) patch grid, bicubically interpolated from the
+        training grid when they differ. Interpolated tables are cached per resolution in eval
+        mode without autograd, until pos_embed is modified.
+        """
+        train_grid_size = self.patch_embed.grid_size
+        if grid_size is None or tuple(grid_size) == tuple(train_grid_size):
+            return self.pos_embed
+
+        use_cache = not self.training and not torch.is_grad_enabled() and not _is_compiling()
+        version = (self.pos_embed.data_ptr(), self.pos_embed._version)
+        if use_cache and grid_size in self._pos_embed_cache:
+            cached_version, pos_embed = self._pos_embed_cache[grid_size]
+            if cached_version == version:
+                return pos_embed
+
+        pos_embed = self.pos_embed.reshape(1, train_grid_size[0], train_grid_size[1], -1).permute(0, 3, 1, 2)
+        pos_embed = F.interpolate(pos_embed, size=grid_size, mode='bicubic', align_corners=False)
+        pos_embed = pos_embed.permute(0, 2, 3, 1).reshape(1, grid_size[0] * grid_size[1], -1)
+        if use_cache:
+            self._pos_embed_cache[grid_size] = (version, pos_embed)
+        return pos_embed
+
     def forward_features(self, x):
-        B = x.shape[0]
+        B, _, H, W = x.shape
         x = self.patch_embed(x)
 
+        # patch layout of this input, None for hybrid backbones whose grid is assumed square
+        grid_size = None
+        if isinstance(self.patch_embed, PatchEmbed):
+            grid_size = (H // self.patch_embed.patch_size[0], W // self.patch_embed.patch_size[1])
+
         cls_tokens = self.cls_token.expand(B, -1, -1)
 
         if self.use_pos_embed:
-            x = x + self.pos_embed
+            x = x + self.get_pos_embed(grid_size)
         x = self.pos_drop(x)
 
         for u,blk in enumerate(self.blocks):
             if u == self.local_up_to_layer :
                 x = torch.cat((cls_tokens, x), dim=1)
-            x = blk(x)
+            if self.grad_checkpoint[u] and self.training and torch.is_grad_enabled():
+                x = checkpoint(partial(blk, grid_size=grid_size), x, **_CHECKPOINT_KWARGS)
+            else:
+                x = blk(x, grid_size)
 
         x = self.norm(x)
         return x[:, 0]
@@ -6,8 +6,15 @@
 #
 
 import os
+import io
 import json
 import random
+import hashlib
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from PIL import Image
 
 from torchvision import datasets, transforms
 from torchvision.datasets.folder import ImageFolder, DatasetFolder, default_loader
@@ -16,6 +23,10 @@ from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.data import create_transform
 
 from typing import Any, Callable, cast, Dict, List, Optional, Tuple
+
+import utils
+from augment import build_worker_transform
+
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
 def has_file_allowed_extension(filename: str, extensions: Tuple[str, ...]) -> bool:
     return filename.lower().endswith(extensions)
@@ -54,58 +65,320 @@ def make_subsampled_dataset(
     return instances
 
 
+class SampleTable(object):
+    """Sequence of (path, label) samples stored as one utf-8 path buffer with offsets and a
+    label array. DataLoader workers forked from the main process share these three arrays
+    instead of touching millions of Python tuples, whose refcount updates would copy the pages.
+    """
+    def __init__(self, paths, offsets, labels, classes=None):
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+        self.classes = classes
+
+    @classmethod
+    def from_samples(cls, samples, classes=None):
+        encoded = [os.fsencode(path) for path, _ in samples]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in encoded], out=offsets[1:])
+        paths = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        labels = np.array([label for _, label in samples], dtype=np.int64)
+        return cls(paths, offsets, labels, classes)
+
+    @classmethod
+    def load(cls, path):
+        index = np.load(path)
+        classes = index['classes'].tolist() if 'classes' in index.files else None
+        return cls(index['paths'], index['offsets'], index['labels'], classes)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = dict(paths=self.paths, offsets=self.offsets, labels=self.labels)
+        if self.classes is not None:
+            arrays['classes'] = np.array(self.classes)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return os.fsdecode(self.paths[start:end].tobytes()), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_subsampled_dataset(directory, class_to_idx, extensions=None, is_valid_file=None, sampling_ratio=1.,
+                            nb_classes=None, cache_dir=None):
+    """make_subsampled_dataset as a SampleTable, cached in cache_dir.
+
+    The cache is keyed on the root, the modification times of the root and of every class
+    directory (adding or removing images only changes the latter) and the sampling parameters. In
+    distributed mode only rank 0 walks the tree, the other ranks wait for it and load the cache.
+    """
+    if cache_dir is None or is_valid_file is not None:
+        return SampleTable.from_samples(make_subsampled_dataset(
+            directory, class_to_idx, extensions, is_valid_file, sampling_ratio=sampling_ratio, nb_classes=nb_classes))
+
+    directory = os.path.abspath(os.path.expanduser(directory))
+    mtimes = [os.stat(directory).st_mtime] + [os.stat(os.path.join(directory, name)).st_mtime
+                                              for name in sorted(class_to_idx)]
+    key = [directory, mtimes, sorted(class_to_idx.items()),
+           list(extensions or ()), sampling_ratio, nb_classes]
+    return load_or_build_table(cache_dir, key, lambda: SampleTable.from_samples(make_subsampled_dataset(
+        directory, class_to_idx, extensions, is_valid_file, sampling_ratio=sampling_ratio, nb_classes=nb_classes)))
+
+
+def load_or_build_table(cache_dir, key, build):
+    """Loads the SampleTable cached in cache_dir under key (a JSON-serializable list), or builds
+    it with build() and caches it. In distributed mode only rank 0 builds and writes it, the
+    other ranks wait for it and load the cache.
+    """
+    key = json.dumps(key)
+    path = os.path.join(cache_dir, 'index_{}.npz'.format(hashlib.sha1(key.encode()).hexdigest()))
+
+    distributed = utils.is_dist_avail_and_initialized()
+    if distributed and not utils.is_main_process():
+        dist.barrier()  # wait for rank 0 to write the index
+    if os.path.exists(path):
+        table = SampleTable.load(path)
+    else:
+        table = build()
+        if utils.is_main_process():
+            table.save(path)
+    if distributed and utils.is_main_process():
+        dist.barrier()
+    return table
+
+
+def make_inat_samples(root, train=True, year=2018, category='name'):
+    """SampleTable of an iNaturalist split, with the category names in classes.
+
+    Class indices follow the order in which categories first appear in the train annotations.
+    """
+    with open(os.path.join(root, 'categories.json')) as json_file:
+        data_catg = json.load(json_file)
+    with open(os.path.join(root, f"train{year}.json")) as json_file:
+        data_for_targeter = json.load(json_file)
+    if train:
+        data = data_for_targeter
+    else:
+        with open(os.path.join(root, f"val{year}.json")) as json_file:
+            data = json.load(json_file)
+
+    # category id -> name at the requested granularity, then name -> index by first appearance
+    names = np.array([catg[category] for catg in data_catg])
+    annotation_names = names[np.array([int(elem['category_id']) for elem in data_for_targeter['annotations']])]
+    unique_names, first_index = np.unique(annotation_names, return_index=True)
+    order = np.argsort(first_index, kind='stable')
+    name_to_target = np.empty(len(unique_names), dtype=np.int64)
+    name_to_target[order] = np.arange(len(unique_names))
+
+    cuts = [elem['file_name'].split('/') for elem in data['images']]
+    paths = [os.path.join(root, cut[0], cut[2], cut[3]) for cut in cuts]
+    image_names = names[np.array([int(cut[2]) for cut in cuts], dtype=np.int64)]
+    targets = name_to_target[np.searchsorted(unique_names, image_names)]
+
+    return SampleTable.from_samples(list(zip(paths, targets)), classes=unique_names[order].tolist())
+
 
 class INatDataset(ImageFolder):
     def __init__(self, root, train=True, year=2018, transform=None, target_transform=None,
-                 category='name', loader=default_loader):
+                 category='name', loader=default_loader, cache_dir=None):
         self.transform = transform
         self.loader = loader
         self.target_transform = target_transform
         self.year = year
         # assert category in ['kingdom','phylum','class','order','supercategory','family','genus','name']
-        path_json = os.path.join(root, f'{"train" if train else "val"}{year}.json')
-        with open(path_json) as json_file:
-            data = json.load(json_file)
-
-        with open(os.path.join(root, 'categories.json')) as json_file:
-            data_catg = json.load(json_file)
-
-        path_json_for_targeter = os.path.join(root, f"train{year}.json")
+        if cache_dir is None:
+            self.samples = make_inat_samples(root, train, year, category)
+        else:
+            json_files = ['categories.json', f"train{year}.json"] + ([] if train else [f"val{year}.json"])
+            key = [os.path.abspath(root), train, year, category] + \
+                [os.stat(os.path.join(root, f)).st_mtime for f in json_files]
+            self.samples = load_or_build_table(cache_dir, key, lambda: make_inat_samples(root, train, year, category))
+        self.classes = self.samples.classes
+        self.nb_classes = len(self.classes)
+        self.targets = self.samples.labels
 
-        with open(path_json_for_targeter) as json_file:
-            data_for_targeter = json.load(json_file)
+    # __getitem__ and __len__ inherited from ImageFolder
 
-        targeter = {}
-        indexer = 0
-        for elem in data_for_targeter['annotations']:
-            king = []
-            king.append(data_catg[int(elem['category_id'])][category])
-            if king[0] not in targeter.keys():
-                targeter[king[0]] = indexer
-                indexer += 1
-        self.nb_classes = len(targeter)
+class PackedImageDataset(object):
+    """Image folder packed by pack_dataset.py into a few large shard files.
 
-        self.samples = []
-        for elem in data['images']:
-            cut = elem['file_name'].split('/')
-            target_current = int(cut[2])
-            path_current = os.path.join(root, cut[0], cut[2], cut[3])
+    Encoded images are read from memory-mapped shards using the offsets, lengths and labels
+    of index.npz, so no file is opened per sample. The shards are mapped lazily in each
+    DataLoader worker.
+    """
+    def __init__(self, root, transform=None, target_transform=None):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
 
-            categors = data_catg[target_current]
-            target_current_true = targeter[categors[category]]
-            self.samples.append((path_current, target_current_true))
+        index = np.load(os.path.join(root, 'index.npz'))
+        self.shard_ids = index['shard']
+        self.offsets = index['offset']
+        self.lengths = index['length']
+        self.targets = index['label']
+        with open(os.path.join(root, 'classes.json')) as json_file:
+            self.classes = json.load(json_file)
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        self._shards = {}
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            path = os.path.join(self.root, 'shard_{:05d}.bin'.format(shard_id))
+            self._shards[shard_id] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def __getstate__(self):
+        # memory maps are reopened in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __getitem__(self, index):
+        shard = self._get_shard(int(self.shard_ids[index]))
+        offset = int(self.offsets[index])
+        data = shard[offset:offset + int(self.lengths[index])]
+        sample = Image.open(io.BytesIO(data.tobytes())).convert('RGB')
+        target = int(self.targets[index])
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def dataset_fingerprint(dataset):
+    """Hash of the samples and labels of a dataset, to key caches of its decoded images."""
+    h = hashlib.sha1('{}:{}'.format(type(dataset).__name__, len(dataset)).encode())
+    samples = getattr(dataset, 'samples', None)
+    if isinstance(samples, SampleTable):
+        for array in (samples.paths, samples.offsets, samples.labels):
+            h.update(np.ascontiguousarray(array).tobytes())
+    elif isinstance(dataset, PackedImageDataset):
+        h.update(os.path.abspath(dataset.root).encode())
+        for array in (dataset.shard_ids, dataset.offsets, dataset.lengths, dataset.targets):
+            h.update(np.ascontiguousarray(array).tobytes())
+    elif samples is not None:
+        h.update(json.dumps([list(sample) for sample in samples]).encode())
+    else:
+        # torchvision CIFAR: the images themselves are in memory
+        h.update(np.ascontiguousarray(dataset.data).tobytes())
+        h.update(np.asarray(dataset.targets, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class CachedEvalDataset(object):
+    """Validation dataset whose preprocessed images are cached in a memory-mapped file.
+
+    The wrapped dataset must return uint8 tensors of shape (3, input_size, input_size), see
+    build_transform with --eval-cache-dir; they are normalized on the device by
+    engine.evaluate. The first evaluation decodes the images and writes them to the cache
+    from the DataLoader workers, later ones only read the cache. The cache is keyed on the
+    dataset fingerprint, the input size and the transform.
+
+    Only rank 0 writes the cache: concurrent writes to a shared mapping from several nodes
+    over NFS can overwrite each other's pages. The other ranks decode the images themselves
+    until the cache is complete, and then only read it.
+    """
+    def __init__(self, dataset, cache_dir, input_size):
+        self.dataset = dataset
+        self.shape = (3, input_size, input_size)
+        key = [dataset_fingerprint(dataset), input_size, repr(getattr(dataset, 'transform', None))]
+        name = 'eval_' + hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        self.images_path = os.path.join(cache_dir, name + '.images')
+        self.targets_path = os.path.join(cache_dir, name + '.targets')
+
+        # read in the main process, the workers do not know the distributed rank
+        self.writable = utils.get_rank() == 0
+        if self.writable:
+            # extending the files leaves the content in place
+            os.makedirs(cache_dir, exist_ok=True)
+            num_samples = len(dataset)
+            for path, size in ((self.images_path, num_samples * int(np.prod(self.shape))),
+                               (self.targets_path, num_samples * 8)):
+                with open(path, 'ab') as f:
+                    if f.tell() != size:
+                        f.truncate(size)
+        self._images = None
+        self._targets = None
+        self._bypass = False
+
+    def _cache_complete(self):
+        """Whether rank 0 has filled every entry of the cache."""
+        num_samples = len(self.dataset)
+        if not os.path.exists(self.targets_path) or os.path.getsize(self.targets_path) != num_samples * 8:
+            return False
+        return bool((np.memmap(self.targets_path, dtype=np.int64, mode='r', shape=(num_samples,)) > 0).all())
+
+    def _open(self):
+        if self._images is None and not self._bypass:
+            if not self.writable and not self._cache_complete():
+                # checked once per worker, the images of this epoch are decoded
+                self._bypass = True
+                return None, None
+            mode = 'r+' if self.writable else 'r'
+            self._images = np.memmap(self.images_path, dtype=np.uint8, mode=mode,
+                                     shape=(len(self.dataset),) + self.shape)
+            # label + 1, 0 marks an image not cached yet
+            self._targets = np.memmap(self.targets_path, dtype=np.int64, mode=mode, shape=(len(self.dataset),))
+        return self._images, self._targets
+
+    def __getstate__(self):
+        # memory maps are reopened in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_targets'] = None
+        state['_bypass'] = False
+        return state
+
+    def __getitem__(self, index):
+        images, targets = self._open()
+        if targets is not None and targets[index] > 0:
+            return torch.from_numpy(np.array(images[index])), int(targets[index]) - 1
+        sample, target = self.dataset[index]
+        assert sample.dtype == torch.uint8 and tuple(sample.shape) == self.shape, \
+            "the eval cache expects uint8 images of shape {}".format(self.shape)
+        if not self.writable:
+            return sample, target
+        images[index] = sample.numpy()
+        # the label is written after the image, it is what marks the entry as valid
+        targets[index] = target + 1
+        return sample, target
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # classes, targets, ... of the wrapped dataset
+        if name.startswith('_') or name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
 
-    # __getitem__ and __len__ inherited from ImageFolder
 
 class SubsampledDatasetFolder(DatasetFolder):
 
-    def __init__(self, root, loader, extensions=None, transform=None, target_transform=None, is_valid_file=None, sampling_ratio=1., nb_classes=None):
+    def __init__(self, root, loader, extensions=None, transform=None, target_transform=None, is_valid_file=None, sampling_ratio=1., nb_classes=None,
+                 index_cache_dir=None):
 
         super(DatasetFolder, self).__init__(root, transform=transform,
                                             target_transform=target_transform)
         
-        classes, class_to_idx = self._find_classes(self.root)
-        samples = make_subsampled_dataset(self.root, class_to_idx, extensions, is_valid_file, sampling_ratio=sampling_ratio, nb_classes=nb_classes)
+        # torchvision renamed _find_classes to find_classes in 0.10
+        find_classes = self.find_classes if hasattr(self, 'find_classes') else self._find_classes
+        classes, class_to_idx = find_classes(self.root)
+        samples = load_subsampled_dataset(self.root, class_to_idx, extensions, is_valid_file, sampling_ratio=sampling_ratio, nb_classes=nb_classes,
+                                          cache_dir=index_cache_dir)
 
         if len(samples) == 0:
             msg = "Found 0 files in subfolders of: {}\n".format(self.root)
@@ -119,7 +392,7 @@ class SubsampledDatasetFolder(DatasetFolder):
         self.classes = classes
         self.class_to_idx = class_to_idx
         self.samples = samples
-        self.targets = [s[1] for s in samples]
+        self.targets = samples.labels
 
     # __getitem__ and __len__ inherited from DatasetFolder
 
@@ -145,23 +418,31 @@ def build_dataset(is_train, args):
     elif args.data_set == 'IMNET':
         root = os.path.join(args.data_path, 'train' if is_train else 'val')
         dataset = ImageNetDataset(root, transform=transform,
-                                  sampling_ratio= (args.sampling_ratio if is_train else 1.), nb_classes=args.nb_classes)
+                                  sampling_ratio= (args.sampling_ratio if is_train else 1.), nb_classes=args.nb_classes,
+                                  index_cache_dir=args.index_cache_dir or None)
         nb_classes = args.nb_classes if args.nb_classes is not None else 1000
     elif args.data_set == 'INAT':
         dataset = INatDataset(args.data_path, train=is_train, year=2018,
-                              category=args.inat_category, transform=transform)
+                              category=args.inat_category, transform=transform,
+                              cache_dir=args.index_cache_dir or None)
         nb_classes = dataset.nb_classes
     elif args.data_set == 'INAT19':
         args.data_path = "/datasets01/inaturalist/090619/"
         dataset = INatDataset(args.data_path, train=is_train, year=2019,
-                              category=args.inat_category, transform=transform)
+                              category=args.inat_category, transform=transform,
+                              cache_dir=args.index_cache_dir or None)
         nb_classes = dataset.nb_classes
 
+    if not is_train and args.eval_cache_dir:
+        dataset = CachedEvalDataset(dataset, args.eval_cache_dir, args.input_size)
     return dataset, nb_classes
 
 
 def build_transform(is_train, args):
     resize_im = args.input_size > 32
+    if is_train and args.device_aug:
+        # crop, flip, color jitter and random erasing run batched on the device, see augment.py
+        return build_worker_transform(args)
     if is_train:
         # this should always dispatch to transforms_imagenet_train
         transform = create_transform(
@@ -189,6 +470,10 @@ def build_transform(is_train, args):
         )
         t.append(transforms.CenterCrop(args.input_size))
 
+    if args.eval_cache_dir:
+        # uint8 images for CachedEvalDataset, normalized on the device by engine.evaluate
+        t.append(transforms.PILToTensor())
+        return transforms.Compose(t)
     t.append(transforms.ToTensor())
     t.append(transforms.Normalize(IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD))
     return transforms.Compose(t)
@@ -8,6 +8,7 @@
 """
 Train and eval functions used in main.py
 """
+import contextlib
 import math
 import sys
 from typing import Iterable, Optional
@@ -18,12 +19,23 @@ from timm.data import Mixup
 from timm.utils import accuracy, ModelEma
 
 import utils
+from augment import normalize
 
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0,
-                    model_ema: Optional[ModelEma] = None, mixup_fn: Optional[Mixup] = None):
+                    model_ema: Optional[ModelEma] = None, mixup_fn: Optional[Mixup] = None,
+                    device_aug: Optional[torch.nn.Module] = None, deferred_sync: bool = False,
+                    accum_steps: int = 1):
+    """With deferred_sync, the losses stay on the device and are copied to the host, logged
+    and checked for non-finite values once every print_freq steps, instead of each step
+    waiting for the device with loss.item() and torch.cuda.synchronize().
+
+    With accum_steps > 1, the gradients of accum_steps consecutive batches are accumulated
+    before each optimizer step. The intermediate backward passes run under
+    DistributedDataParallel.no_sync(), so the gradients are all-reduced once per step.
+    """
     # TODO fix this for finetuning
     model.train()
     criterion.train()
@@ -31,36 +43,69 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
+    pending_losses = []
+    optimizer.zero_grad()
 
-    for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
+    for step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
         samples = samples.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
 
+        if device_aug is not None:
+            samples = device_aug(samples)
+
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
 
-        with torch.cuda.amp.autocast():
+        # the optimizer steps on the last batch of each group of accum_steps, and on the last batch
+        optimizer_step = (step + 1) % accum_steps == 0 or step == len(data_loader) - 1
+        # the losses are averaged over the batches of the group, fewer in the last one of an epoch
+        group_start = step - step % accum_steps
+        group_size = min(accum_steps, len(data_loader) - group_start)
+        # forward and backward both run under no_sync for DDP to skip the all-reduce
+        no_sync = model.no_sync if not optimizer_step and hasattr(model, 'no_sync') else contextlib.nullcontext
+
+        with no_sync(), torch.cuda.amp.autocast():
             outputs = model(samples)
             loss = criterion(outputs, targets)
 
-        loss_value = loss.item()
+        if deferred_sync:
+            pending_losses.append(loss.detach())
+        else:
+            loss_value = loss.item()
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
-
-        optimizer.zero_grad()
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                sys.exit(1)
 
         # this attribute is added by timm on one optimizer (adahessian)
         is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        loss_scaler(loss, optimizer, clip_grad=max_norm,
-                    parameters=model.parameters(), create_graph=is_second_order)
-
-        torch.cuda.synchronize()
-        if model_ema is not None:
+        if not optimizer_step:
+            # same loss scale as the final backward, unscaling and clipping happen once in loss_scaler
+            with no_sync():
+                loss_scaler._scaler.scale(loss / group_size).backward(create_graph=is_second_order)
+        else:
+            loss_scaler(loss / group_size, optimizer, clip_grad=max_norm,
+                        parameters=model.parameters(), create_graph=is_second_order)
+            optimizer.zero_grad()
+
+        if not deferred_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if model_ema is not None and optimizer_step:
             model_ema.update(model)
 
-        metric_logger.update(loss=loss_value)
+        if deferred_sync:
+            # the steps at which log_every prints
+            if step % print_freq == 0 or step == len(data_loader) - 1:
+                loss_values = torch.stack(pending_losses).float().tolist()
+                pending_losses = []
+                for i, loss_value in enumerate(loss_values):
+                    if not math.isfinite(loss_value):
+                        print("Loss is {} at step {}, stopping training".format(
+                            loss_value, step - len(loss_values) + 1 + i))
+                        sys.exit(1)
+                    metric_logger.update(loss=loss_value)
+        else:
+            metric_logger.update(loss=loss_value)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -81,6 +126,9 @@ def evaluate(data_loader, model, device):
     for images, target in metric_logger.log_every(data_loader, 10, header):
         images = images.to(device, non_blocking=True)
         target = target.to(device, non_blocking=True)
+        if images.dtype == torch.uint8:
+            # images from the eval cache, see datasets.CachedEvalDataset
+            images = normalize(images)
 
         # compute output
         with torch.cuda.amp.autocast():
@@ -98,3 +146,86 @@ def evaluate(data_loader, model, device):
           .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
 
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+
+
+@torch.no_grad()
+def evaluate_verification(data_loader, model, device, far_targets=(1e-4, 1e-3, 1e-2), chunk_size=None,
+                          num_bins=2000, memory_budget=2**30):
+    """Face verification and identification metrics of an embedding model.
+
+    The data is streamed once into a preallocated buffer of L2-normalized embeddings. The
+    cosine similarities are then computed chunk_size rows at a time: every pair goes into a
+    genuine or impostor histogram (TAR at the given FARs) and every image is used as a
+    query against all the others (leave-one-out rank-1 / rank-5 identification). Each chunk
+    takes about 24 bytes per pair on the device; by default chunk_size is the number of rows
+    that fit in memory_budget bytes.
+    """
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Test:'
+
+    # switch to evaluation mode
+    model.eval()
+
+    num_samples = len(data_loader.dataset)
+    embeddings, labels = None, torch.empty(num_samples, dtype=torch.int64, device=device)
+    offset = 0
+    for images, target in metric_logger.log_every(data_loader, 10, header):
+        images = images.to(device, non_blocking=True)
+        if images.dtype == torch.uint8:
+            # images from the eval cache, see datasets.CachedEvalDataset
+            images = normalize(images)
+
+        with torch.cuda.amp.autocast():
+            output = model(images)
+
+        if embeddings is None:
+            embeddings = torch.empty(num_samples, output.shape[1], device=device)
+        batch_size = images.shape[0]
+        embeddings[offset:offset + batch_size] = torch.nn.functional.normalize(output.float(), dim=1)
+        labels[offset:offset + batch_size] = target.to(device, non_blocking=True)
+        offset += batch_size
+    assert offset == num_samples, "the data loader must yield every sample exactly once"
+
+    if chunk_size is None:
+        chunk_size = max(memory_budget // (24 * num_samples), 1)
+    genuine = torch.zeros(num_bins, dtype=torch.int64, device=device)
+    impostor = torch.zeros(num_bins, dtype=torch.int64, device=device)
+    rank1 = rank5 = num_queries = 0
+    columns = torch.arange(num_samples, device=device).view(1, -1)
+    for start in range(0, num_samples, chunk_size):
+        end = min(start + chunk_size, num_samples)
+        similarity = embeddings[start:end] @ embeddings.t()
+        same = labels[start:end].view(-1, 1) == labels.view(1, -1)
+        rows = torch.arange(start, end, device=device).view(-1, 1)
+
+        # each pair once: the columns after the row
+        upper = columns > rows
+        scaled = similarity.add(1).mul_(num_bins / 2)
+        bins = scaled.int().clamp_(0, num_bins - 1)
+        del scaled
+        genuine += torch.bincount(bins[upper & same], minlength=num_bins)
+        impostor += torch.bincount(bins[upper & ~same], minlength=num_bins)
+
+        # identification, only for the queries with another image of the same identity
+        similarity.masked_fill_(columns == rows, -float('inf'))
+        has_match = (same & (columns != rows)).any(dim=1)
+        top = similarity.topk(min(5, num_samples - 1), dim=1)[1]
+        hits = labels[top] == labels[start:end].view(-1, 1)
+        rank1 += (hits[:, 0] & has_match).sum()
+        rank5 += (hits.any(dim=1) & has_match).sum()
+        num_queries += has_match.sum()
+
+    # TAR at the lowest similarity threshold whose FAR does not exceed each target
+    tar = genuine.flip(0).cumsum(0).double() / max(genuine.sum().item(), 1)
+    far = impostor.flip(0).cumsum(0).double() / max(impostor.sum().item(), 1)
+    stats = {}
+    for target in far_targets:
+        below = (far <= target).nonzero(as_tuple=False)
+        stats['tar@far={:g}'.format(target)] = 100 * tar[below[-1, 0]].item() if len(below) else 0.
+    num_queries = max(int(num_queries), 1)
+    stats['rank1'] = 100 * int(rank1) / num_queries
+    stats['rank5'] = 100 * int(rank5) / num_queries
+
+    print('* Rank-1 {:.3f} Rank-5 {:.3f} '.format(stats['rank1'], stats['rank5'])
+          + ' '.join('TAR@FAR={:g} {:.3f}'.format(t, stats['tar@far={:g}'.format(t)]) for t in far_targets))
+    return stats
@@ -0,0 +1,174 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Computes the embeddings of an image folder (or a folder packed by pack_dataset.py) with a
+trained checkpoint:
+
+    python export_embeddings.py --checkpoint output/checkpoint.pth --data-path /path/to/images \
+        --output-dir /path/to/embeddings --num-workers 16
+
+The output directory contains embeddings.npy (float32, one L2-normalized row per image),
+ids.npy and labels.npy (index and class of every image in the dataset), paths.txt for
+image folders and progress.json. The .npy files are preallocated and filled in dataset
+order; progress.json records how many rows are written, an interrupted export resumes
+from there when run again with the same arguments and an unchanged checkpoint file. The model arguments default to the
+ones saved in the checkpoint.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+from torchvision.datasets.folder import DatasetFolder, default_loader
+
+from timm.models import create_model
+
+from augment import canvas_size, normalize
+from checkpoint import load_checkpoint
+from datasets import IMG_EXTENSIONS, PackedImageDataset
+import models
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Embedding export', add_help=False)
+    parser.add_argument('--checkpoint', required=True, type=str, help='checkpoint saved by train_vggface2.py')
+    parser.add_argument('--data-path', required=True, type=str, help='image folder or packed folder')
+    parser.add_argument('--data-format', default='folder', choices=['folder', 'packed'], type=str)
+    parser.add_argument('--output-dir', required=True, type=str, help='where to write the embeddings')
+    parser.add_argument('--batch-size', default=128, type=int)
+    parser.add_argument('--num-workers', default=8, type=int, help='DataLoader processes decoding the images')
+    parser.add_argument('--num-threads', default=None, type=int, help='torch threads for the model on CPU')
+    parser.add_argument('--device', default='cpu', help='device to use for the model')
+    parser.add_argument('--flush-every', default=50, type=int, help='batches between two progress saves')
+
+    # model parameters, default to the ones of the checkpoint
+    parser.add_argument('--model', default=None, type=str)
+    parser.add_argument('--input-size', default=None, type=int)
+    parser.add_argument('--embed_dim', default=None, type=int)
+    parser.add_argument('--image_embed_dim', default=None, type=int)
+    parser.add_argument('--local_up_to_layer', default=None, type=int)
+    parser.add_argument('--locality_strength', default=None, type=float)
+    return parser
+
+
+def load_model(args):
+    checkpoint = load_checkpoint(args.checkpoint, map_location='cpu')
+    train_args = checkpoint.get('args')
+    for name in ('model', 'input_size', 'embed_dim', 'image_embed_dim', 'local_up_to_layer', 'locality_strength'):
+        if getattr(args, name) is None:
+            # checkpoints of main.py have no image_embed_dim, older ones no args at all
+            assert getattr(train_args, name, None) is not None, \
+                "--{} is required, the checkpoint args do not have it".format(
+                    'input-size' if name == 'input_size' else name)
+            setattr(args, name, getattr(train_args, name))
+    model = create_model(
+        args.model,
+        pretrained=False,
+        num_classes=args.image_embed_dim,
+        local_up_to_layer=args.local_up_to_layer,
+        locality_strength=args.locality_strength,
+        embed_dim=args.embed_dim,
+    )
+    model.load_state_dict(checkpoint['model'])
+    return model
+
+
+def build_dataset(args):
+    # the evaluation transform, as uint8 normalized on the device
+    size = canvas_size(args.input_size)
+    transform = transforms.Compose([
+        transforms.Resize(size, interpolation=3),
+        transforms.CenterCrop(args.input_size),
+        transforms.PILToTensor(),
+    ])
+    if args.data_format == 'packed':
+        return PackedImageDataset(args.data_path, transform=transform)
+    return DatasetFolder(args.data_path, default_loader, extensions=IMG_EXTENSIONS, transform=transform)
+
+
+def open_outputs(args, dataset, dim):
+    """Memory-mapped outputs and the number of rows already written."""
+    os.makedirs(args.output_dir, exist_ok=True)
+    num_samples = len(dataset)
+    progress_path = os.path.join(args.output_dir, 'progress.json')
+    # the checkpoint path is rewritten every epoch during training, its mtime and size tell the saves apart
+    checkpoint_stat = os.stat(args.checkpoint)
+    config = dict(checkpoint=os.path.abspath(args.checkpoint), checkpoint_mtime=checkpoint_stat.st_mtime,
+                  checkpoint_size=checkpoint_stat.st_size, data_path=os.path.abspath(args.data_path),
+                  num_samples=num_samples, dim=dim, input_size=args.input_size)
+    done = 0
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress['config'] == config:
+            done = progress['done']
+        else:
+            print('progress.json is from another export, starting over')
+
+    mode = 'r+' if done > 0 else 'w+'
+    path = lambda name: os.path.join(args.output_dir, name)
+    embeddings = np.lib.format.open_memmap(path('embeddings.npy'), mode=mode, dtype=np.float32,
+                                           shape=(num_samples, dim))
+    if done == 0:
+        np.save(path('ids.npy'), np.arange(num_samples, dtype=np.int64))
+        np.save(path('labels.npy'), np.asarray(dataset.targets, dtype=np.int64))
+        if isinstance(dataset, DatasetFolder):
+            with open(path('paths.txt'), 'w') as f:
+                for sample_path, _ in dataset.samples:
+                    f.write(os.path.relpath(sample_path, args.data_path) + '\n')
+    return embeddings, done, lambda done: save_progress(progress_path, config, done)
+
+
+def save_progress(path, config, done):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(config=config, done=done), f)
+    os.replace(path + '.tmp', path)
+
+
+@torch.no_grad()
+def main(args):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+    model = load_model(args).to(device).eval()
+    dataset = build_dataset(args)
+    dim = model.num_classes or model.num_features
+    embeddings, done, save = open_outputs(args, dataset, dim)
+    num_samples = len(dataset)
+    if done == num_samples:
+        print('all {} embeddings already exported to {}'.format(num_samples, args.output_dir))
+        return
+    print('exporting {} embeddings of dim {}, starting at {}'.format(num_samples, dim, done))
+
+    data_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, range(done, num_samples)),
+        batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
+        pin_memory=device.type == 'cuda', drop_last=False,
+    )
+    start_time = time.time()
+    for i, (images, _) in enumerate(data_loader):
+        images = normalize(images.to(device, non_blocking=True))
+        output = F.normalize(model(images).float(), dim=1)
+        embeddings[done:done + len(output)] = output.cpu().numpy()
+        done += len(output)
+        if (i + 1) % args.flush_every == 0 or done == num_samples:
+            # rows first, then the progress that points past them
+            embeddings.flush()
+            save(done)
+            rate = (i + 1) * args.batch_size / (time.time() - start_time)
+            print('{}/{} embeddings, {:.1f} images/s'.format(done, num_samples, rate))
+    print('exported {} embeddings to {}'.format(num_samples, args.output_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Embedding export', parents=[get_args_parser()])
+    main(parser.parse_args())
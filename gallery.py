@@ -0,0 +1,289 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Gallery indexes for 1:N face identification over L2-normalized embeddings.
+
+ExactIndex scores the queries against every gallery embedding, one block at a time, and
+IVFIndex only against the embeddings of the nprobe inverted lists closest to each query.
+Both store the embeddings as float32, float16 or int8 (one scale per embedding), support
+add / remove by id and are saved as .npy files that load memory-mapped:
+
+    index = IVFIndex(dim=128, nlist=1024, dtype='int8')
+    index.train(embeddings)
+    index.add(embeddings, ids)
+    index.save('/path/to/gallery')
+    scores, ids = IVFIndex.load('/path/to/gallery').search(queries, k=10)
+"""
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+
+
+def _as_tensor(x):
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(np.ascontiguousarray(x))
+    return x.float()
+
+
+class ExactIndex(object):
+    """Brute-force inner product search, exact up to the storage precision.
+
+    The gallery is scanned block_size embeddings at a time, each block decoded to float32
+    and multiplied with all the queries, keeping a running top-k, so the memory is
+    O(block_size * (dim + num_queries)) whatever the gallery size. Removed embeddings are
+    tombstoned and dropped by compact().
+    """
+    def __init__(self, dim, dtype='float16', block_size=65536):
+        assert dtype in STORAGE_DTYPES, "dtype must be one of {}".format(sorted(STORAGE_DTYPES))
+        self.dim = dim
+        self.dtype = dtype
+        self.block_size = block_size
+        self.ntotal = 0
+        self.vectors = np.zeros((0, dim), dtype=STORAGE_DTYPES[dtype])
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return int(self.alive[:self.ntotal].sum())
+
+    def encode(self, embeddings):
+        """Normalized embeddings in the storage dtype, and their int8 scales."""
+        embeddings = F.normalize(_as_tensor(embeddings), dim=1).numpy()
+        if self.dtype != 'int8':
+            return embeddings.astype(STORAGE_DTYPES[self.dtype]), np.ones(len(embeddings), dtype=np.float32)
+        scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def decode(self, rows):
+        """float32 tensor of the stored embeddings rows (a slice or an index array)."""
+        vectors = torch.from_numpy(np.asarray(self.vectors[rows], dtype=np.float32))
+        if self.dtype == 'int8':
+            vectors *= torch.from_numpy(np.asarray(self.scales[rows])).view(-1, 1)
+        return vectors
+
+    def _reserve(self, num_rows):
+        # grows the arrays geometrically, which also copies them out of the memory map after a load
+        capacity = len(self.ids)
+        if self.ntotal + num_rows <= capacity:
+            return
+        capacity = max(self.ntotal + num_rows, 2 * capacity, 1024)
+        for name in ('vectors', 'scales', 'ids', 'alive'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.ntotal] = old[:self.ntotal]
+            setattr(self, name, new)
+
+    def add(self, embeddings, ids):
+        vectors, scales = self.encode(embeddings)
+        num_rows = len(vectors)
+        self._reserve(num_rows)
+        rows = slice(self.ntotal, self.ntotal + num_rows)
+        self.vectors[rows] = vectors
+        self.scales[rows] = scales
+        self.ids[rows] = np.asarray(ids, dtype=np.int64)
+        self.alive[rows] = True
+        self.ntotal += num_rows
+        return rows
+
+    def remove(self, ids):
+        """Tombstones the embeddings with these ids, returns how many were removed."""
+        removed = np.isin(self.ids[:self.ntotal], np.asarray(ids, dtype=np.int64)) & self.alive[:self.ntotal]
+        self.alive[:self.ntotal][removed] = False
+        return int(removed.sum())
+
+    def compact(self):
+        """Drops the removed embeddings, the row numbers change."""
+        keep = np.nonzero(self.alive[:self.ntotal])[0]
+        for name in ('vectors', 'scales', 'ids', 'alive'):
+            setattr(self, name, np.array(getattr(self, name)[keep]))
+        self.ntotal = len(keep)
+        return keep
+
+    def _score(self, queries, rows, k):
+        """Top-k inner products of the queries with the stored rows, as (scores, row numbers)."""
+        vectors = self.decode(rows)
+        scores = queries @ vectors.t()
+        row_numbers = torch.arange(rows.start, rows.stop) if isinstance(rows, slice) else torch.from_numpy(rows)
+        scores.masked_fill_(~torch.from_numpy(np.asarray(self.alive[rows])).view(1, -1), -float('inf'))
+        scores, top = scores.topk(min(k, scores.shape[1]), dim=1)
+        return scores, row_numbers[top]
+
+    @staticmethod
+    def _merge(best, candidate, k):
+        if best is None:
+            return candidate
+        # blocks smaller than k give fewer than k candidates until enough are merged
+        merged = torch.cat([best[0], candidate[0]], dim=1)
+        scores, top = merged.topk(min(k, merged.shape[1]), dim=1)
+        return scores, torch.cat([best[1], candidate[1]], dim=1).gather(1, top)
+
+    def _result(self, best, num_queries, k):
+        scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        ids = np.full((num_queries, k), -1, dtype=np.int64)
+        if best is not None:
+            found = min(k, best[0].shape[1])
+            scores[:, :found] = best[0].numpy()
+            ids[:, :found] = np.where(np.isfinite(scores[:, :found]), self.ids[best[1].numpy()], -1)
+        return scores, ids
+
+    @torch.no_grad()
+    def search(self, queries, k=10):
+        """(scores, ids) of the k nearest gallery embeddings of each query, -1 ids when the
+        gallery has fewer than k embeddings.
+        """
+        queries = F.normalize(_as_tensor(queries), dim=1)
+        best = None
+        for start in range(0, self.ntotal, self.block_size):
+            rows = slice(start, min(start + self.block_size, self.ntotal))
+            best = self._merge(best, self._score(queries, rows, k), k)
+        return self._result(best, len(queries), k)
+
+    def _config(self):
+        return dict(type=type(self).__name__, dim=self.dim, dtype=self.dtype, block_size=self.block_size,
+                    ntotal=self.ntotal)
+
+    def _arrays(self):
+        return ('vectors', 'scales', 'ids', 'alive')
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        config_path = os.path.join(directory, 'config.json')
+        if os.path.exists(config_path):
+            os.remove(config_path)
+        for name in self._arrays():
+            # replaced rather than overwritten, the index may be memory-mapped from these files
+            path = os.path.join(directory, name + '.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, name)[:self._rows(name)])
+            os.replace(path + '.tmp', path)
+        # written last, a directory without config.json is an incomplete save
+        with open(config_path, 'w') as f:
+            json.dump(self._config(), f)
+
+    def _rows(self, name):
+        return self.ntotal
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Loads a saved index. With mmap the arrays are memory-mapped copy-on-write: they are
+        paged in on demand and changes stay in memory until the next save.
+        """
+        with open(os.path.join(directory, 'config.json')) as f:
+            config = json.load(f)
+        assert config.pop('type') == cls.__name__, "the index in {} is not a {}".format(directory, cls.__name__)
+        ntotal = config.pop('ntotal')
+        index = cls(**config)
+        for name in index._arrays():
+            setattr(index, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='c' if mmap else None))
+        index.ntotal = ntotal
+        return index
+
+
+class IVFIndex(ExactIndex):
+    """Inverted file index: the gallery is partitioned by spherical k-means into nlist lists
+    and a query only scans the nprobe lists with the closest centroids.
+    """
+    def __init__(self, dim, nlist=1024, nprobe=16, dtype='float16', block_size=65536):
+        super().__init__(dim, dtype=dtype, block_size=block_size)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists = np.zeros(0, dtype=np.int32)
+        self._inverted = None
+
+    @torch.no_grad()
+    def train(self, embeddings, iters=10, max_samples_per_list=256, seed=0):
+        """Spherical k-means on at most nlist * max_samples_per_list embeddings."""
+        embeddings = F.normalize(_as_tensor(embeddings), dim=1)
+        g = torch.Generator()
+        g.manual_seed(seed)
+        num_samples = min(len(embeddings), self.nlist * max_samples_per_list)
+        assert num_samples >= self.nlist, "need at least nlist={} embeddings to train".format(self.nlist)
+        samples = embeddings[torch.randperm(len(embeddings), generator=g)[:num_samples]]
+        centroids = samples[:self.nlist].clone()
+        for _ in range(iters):
+            assignment = self._assign(samples, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, samples)
+            counts = torch.bincount(assignment, minlength=self.nlist)
+            # empty lists are restarted on random samples
+            empty = counts == 0
+            sums[empty] = samples[torch.randint(num_samples, (int(empty.sum()),), generator=g)]
+            centroids = F.normalize(sums, dim=1)
+        self.centroids = centroids.numpy()
+
+    def _assign(self, embeddings, centroids):
+        assignment = torch.empty(len(embeddings), dtype=torch.int64)
+        for start in range(0, len(embeddings), self.block_size):
+            end = min(start + self.block_size, len(embeddings))
+            assignment[start:end] = (embeddings[start:end] @ centroids.t()).argmax(dim=1)
+        return assignment
+
+    def add(self, embeddings, ids):
+        assert self.centroids is not None, "train the index before adding embeddings"
+        rows = super().add(embeddings, ids)
+        if len(self.lists) < len(self.ids):
+            lists = np.zeros(len(self.ids), dtype=np.int32)
+            lists[:rows.start] = self.lists[:rows.start]
+            self.lists = lists
+        self.lists[rows] = self._assign(self.decode(rows), torch.from_numpy(self.centroids)).numpy()
+        self._inverted = None
+        return rows
+
+    def compact(self):
+        keep = super().compact()
+        self.lists = np.array(self.lists[keep])
+        self._inverted = None
+        return keep
+
+    def inverted_lists(self):
+        """Row numbers sorted by list, and the start of each list, rebuilt after an add."""
+        if self._inverted is None:
+            lists = np.asarray(self.lists[:self.ntotal])
+            order = np.argsort(lists, kind='stable')
+            starts = np.zeros(self.nlist + 1, dtype=np.int64)
+            np.cumsum(np.bincount(lists, minlength=self.nlist), out=starts[1:])
+            self._inverted = order, starts
+        return self._inverted
+
+    @torch.no_grad()
+    def search(self, queries, k=10, nprobe=None):
+        queries = F.normalize(_as_tensor(queries), dim=1)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = (queries @ torch.from_numpy(self.centroids).t()).topk(nprobe, dim=1)[1].numpy()
+        order, starts = self.inverted_lists()
+        # list by list, each scanned once for all the queries probing it
+        best = (torch.full((len(queries), k), -float('inf')), torch.zeros(len(queries), k, dtype=torch.int64))
+        probed = torch.from_numpy(probes)
+        for l in np.unique(probes):
+            rows = order[starts[l]:starts[l + 1]]
+            if len(rows) == 0:
+                continue
+            rows = np.sort(rows)  # sequential reads of the memory map
+            query_index = (probed == int(l)).any(dim=1).nonzero(as_tuple=False).squeeze(1)
+            for start in range(0, len(rows), self.block_size):
+                candidate = self._score(queries[query_index], rows[start:start + self.block_size], k)
+                merged = self._merge((best[0][query_index], best[1][query_index]), candidate, k)
+                best[0][query_index], best[1][query_index] = merged
+        return self._result(best, len(queries), k)
+
+    def _config(self):
+        config = super()._config()
+        config.update(nlist=self.nlist, nprobe=self.nprobe)
+        return config
+
+    def _arrays(self):
+        return super()._arrays() + ('lists', 'centroids')
+
+    def _rows(self, name):
+        return self.nlist if name == 'centroids' else self.ntotal
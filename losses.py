@@ -0,0 +1,170 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Metric learning losses for the VGGFace2 experiments.
+"""
+import inspect
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+import utils
+
+# non-reentrant checkpointing when this torch version has it, as in convit.py
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+class GatherLayer(torch.autograd.Function):
+    """all_gather of equally sized tensors, differentiable: the gradient of the gathered
+    tensor is summed over the processes and each one keeps the slice of its own shard.
+    Works with the nccl and gloo backends.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        gathered = [torch.empty_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, x.contiguous())
+        return torch.cat(gathered)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        dist.all_reduce(grad_output)
+        return grad_output.chunk(dist.get_world_size())[dist.get_rank()]
+
+
+def gather_across_ranks(feature_vectors, labels):
+    """Embeddings and labels of the global batch, in rank order. Gradients flow back to the
+    local shard of every process. All processes must have the same batch size.
+    """
+    if not utils.is_dist_avail_and_initialized():
+        return feature_vectors, labels
+    gathered_labels = [torch.empty_like(labels) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered_labels, labels.contiguous())
+    return GatherLayer.apply(feature_vectors), torch.cat(gathered_labels)
+
+
+class EmbeddingMemoryBank(nn.Module):
+    """FIFO queue of the embeddings and labels of the last batches, kept on the device as
+    buffers so that it follows the criterion in .to() and state_dict(). Empty slots have
+    label -1 and are ignored by CustomContrastiveLoss.
+    """
+    def __init__(self, size, dim):
+        super(EmbeddingMemoryBank, self).__init__()
+        self.size = size
+        self.register_buffer('feats', torch.zeros(size, dim))
+        self.register_buffer('labels', torch.full((size,), -1, dtype=torch.int64))
+        self.register_buffer('ptr', torch.zeros((), dtype=torch.int64))
+
+    @torch.no_grad()
+    def enqueue(self, feature_vectors, labels):
+        # the last self.size embeddings if the batch is larger than the bank
+        feature_vectors, labels = feature_vectors[-self.size:], labels[-self.size:]
+        # indices computed on the device, no host synchronization
+        index = (self.ptr + torch.arange(len(labels), device=self.ptr.device)) % self.size
+        self.feats[index] = feature_vectors.detach().to(self.feats.dtype)
+        self.labels[index] = labels
+        self.ptr.copy_((self.ptr + len(labels)) % self.size)
+
+
+def _contrastive_chunk(rows, columns, row_labels, column_labels, row_offset, margin, hard_negatives=0):
+    """Sums of the positive and negative terms of the rows [row_offset, row_offset + len(rows))
+    of the distance matrix, and the number of positive and negative pairs. With hard_negatives,
+    the negatives of a row are its min(hard_negatives, valid negatives) hardest ones.
+    """
+    distances = torch.cdist(rows, columns)
+    same = row_labels.view(-1, 1) == column_labels.view(1, -1)
+    valid = (column_labels >= 0).view(1, -1)
+    # self-pairs are at distance 0, they are left out of the positive sum
+    column_index = torch.arange(len(column_labels), device=column_labels.device).view(1, -1)
+    diagonal = column_index == torch.arange(row_offset, row_offset + len(rows), device=column_labels.device).view(-1, 1)
+    positive_sum = distances.masked_fill(~same | diagonal, 0).sum()
+    hinge = torch.clamp(margin - distances.masked_fill(same, 0), min=0)
+    if hard_negatives:
+        # the hardest negatives of every anchor, the pairs beyond the margin have a zero hinge
+        hinge = hinge.masked_fill(same | ~valid, 0)
+        negative_sum = hinge.topk(min(hard_negatives, hinge.shape[1]), dim=1)[0].sum()
+        # rows with fewer negatives than hard_negatives also pick masked pairs, which add 0 and are not counted
+        num_negatives = (~same & valid).sum(dim=1).clamp(max=hard_negatives).sum()
+    else:
+        # as in the original dense loss, same-identity pairs count as distance 0 in the negative
+        # numerator, so each of them adds max(margin, 0)
+        negative_sum = hinge.masked_fill(~valid, 0).sum()
+        num_negatives = (~same & valid).sum()
+    return positive_sum, negative_sum, same.sum(), num_negatives
+
+
+class CustomContrastiveLoss(nn.Module):
+    """/!\\ placeholder for a custom loss function
+
+    Mean distance of the positive pairs (same identity, self-pairs excluded) plus the hinge
+    max(margin - d, 0) averaged over the negative pairs. The B x B distance matrix is computed
+    chunk_size rows at a time, each chunk recomputed in the backward pass, so the peak memory
+    is O(chunk_size * B) instead of several B x B matrices.
+
+    With gather=True and distributed training, the pairs are those of the global batch
+    gathered from all processes, so the number of negatives grows with the world size.
+    Every process then computes the same global loss, and the gathered gradients are summed
+    across processes to make up for DistributedDataParallel averaging them.
+
+    With a memory_bank, the embeddings of the previous batches are used as extra (constant)
+    positives and negatives of the current batch, which is then added to the bank. With
+    hard_negatives=k, the negative term only averages the k largest hinges of each anchor
+    instead of all negative pairs, most of which are beyond the margin.
+
+    Args:
+        margin (float): margin of the negative pairs
+        chunk_size (int): rows of the distance matrix computed at once
+        gather (bool): compute the loss on the batch gathered across processes
+        memory_bank (EmbeddingMemoryBank): queue of recent embeddings, or None
+        hard_negatives (int): negatives kept per anchor, 0 to use them all
+    """
+    def __init__(self, margin=1., chunk_size=1024, gather=False, memory_bank=None, hard_negatives=0):
+        super(CustomContrastiveLoss, self).__init__()
+        self.margin = margin
+        self.chunk_size = chunk_size
+        self.gather = gather
+        self.memory_bank = memory_bank
+        self.hard_negatives = hard_negatives
+
+    def forward(self, feature_vectors, labels):
+        if self.gather:
+            feature_vectors, labels = gather_across_ranks(feature_vectors, labels)
+        batch_size = len(labels)
+        columns, column_labels = feature_vectors, labels
+        if self.memory_bank is not None:
+            columns = torch.cat([feature_vectors, self.memory_bank.feats.to(feature_vectors.dtype)])
+            column_labels = torch.cat([labels, self.memory_bank.labels])
+        use_checkpoint = feature_vectors.requires_grad and torch.is_grad_enabled()
+        positive_sum = negative_sum = 0.
+        num_same = num_different = 0
+        for start in range(0, batch_size, self.chunk_size):
+            end = min(start + self.chunk_size, batch_size)
+            args = (feature_vectors[start:end], columns, labels[start:end], column_labels, start, self.margin,
+                    self.hard_negatives)
+            if use_checkpoint:
+                chunk = checkpoint(_contrastive_chunk, *args, **_CHECKPOINT_KWARGS)
+            else:
+                chunk = _contrastive_chunk(*args)
+            positive_sum = positive_sum + chunk[0]
+            negative_sum = negative_sum + chunk[1]
+            num_same = num_same + chunk[2]
+            num_different = num_different + chunk[3]
+        if self.memory_bank is not None and self.training:
+            self.memory_bank.enqueue(feature_vectors, labels)
+
+        # Loss for positive pairs (same person)
+        positive_loss = positive_sum / (num_same - batch_size)
+
+        # Loss for negative pairs (different people)
+        negative_loss = negative_sum / torch.clamp(num_different, min=1)
+
+        # Total loss
+        loss = positive_loss + negative_loss
+        return loss
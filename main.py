@@ -6,6 +6,7 @@
 #
 
 import argparse
+import os
 import datetime
 import numpy as np
 import time
@@ -25,7 +26,9 @@ from timm.utils import NativeScaler, get_state_dict, ModelEma
 
 from datasets import build_dataset
 from engine import train_one_epoch, evaluate
+from checkpoint import AsyncCheckpointWriter, load_checkpoint, save_sharded
 from samplers import RASampler
+from augment import DeviceAugment, normalize
 import models
 import utils
 
@@ -49,6 +52,11 @@ def get_args_parser():
                         help='Drop path rate (default: 0.1)')
     parser.add_argument('--drop-block', type=float, default=None, metavar='PCT',
                         help='Drop block rate (default: None)')
+    parser.add_argument('--fused-attn', action='store_true', default=False,
+                        help='Compute attention with torch scaled_dot_product_attention instead of explicit attention maps')
+    parser.add_argument('--grad-checkpoint', type=str, default=None,
+                        help='Recompute block activations in backward to save memory: '
+                             '"all", "gpsa", "mhsa" or k for every k-th block (default: None)')
 
     parser.add_argument('--model-ema', action='store_true')
     parser.add_argument('--no-model-ema', action='store_false', dest='model_ema')
@@ -106,9 +114,18 @@ def get_args_parser():
     parser.add_argument('--train-interpolation', type=str, default='bicubic',
                         help='Training interpolation (random, bilinear, bicubic default: "bicubic")')
 
+    parser.add_argument('--deferred-sync', action='store_true',
+                        help='copy the training losses to the host every print_freq steps instead of every step')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='train with torch.compile (torch>=2.0), static shapes; evaluation stays eager')
+    parser.add_argument('--accum-steps', default=1, type=int,
+                        help='batches whose gradients are accumulated (without all-reduce) before each optimizer step')
+    parser.add_argument('--device-aug', action='store_true', default=False,
+                        help='Workers only decode and resize, crop/flip/color jitter/random erasing run batched on the device')
     parser.add_argument('--repeated-aug', action='store_true')
     parser.add_argument('--no-repeated-aug', action='store_false', dest='repeated_aug')
     parser.set_defaults(repeated_aug=True)
+    parser.add_argument('--ra-reps', default=3, type=int, help='number of repetitions of each sample with --repeated-aug')
 
     # * Random Erase params
     parser.add_argument('--reprob', type=float, default=0.25, metavar='PCT',
@@ -143,6 +160,10 @@ def get_args_parser():
                         type=float, help='fraction of samples to keep in the training set of imagenet')
     parser.add_argument('--nb_classes', default=None,
                         type=int, help='number of classes in imagenet')
+    parser.add_argument('--index-cache-dir', default=os.path.expanduser('~/.cache/convit'), type=str,
+                        help='where to cache the file index of image folders, empty to disable')
+    parser.add_argument('--eval-cache-dir', default='', type=str,
+                        help='cache the preprocessed validation images in this directory (default: disabled)')
     parser.add_argument('--inat-category', default='name',
                         choices=['kingdom', 'phylum', 'class', 'order', 'supercategory', 'family', 'genus', 'name'],
                         type=str, help='semantic granularity')
@@ -154,6 +175,10 @@ def get_args_parser():
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--save_every', default=None, type=int, help='save model every epochs')
+    parser.add_argument('--keep-checkpoints', default=None, type=int,
+                        help='number of checkpoint_<epoch>.pth files to keep, at least 1 (default: all)')
+    parser.add_argument('--checkpoint-format', default='pickle', choices=['pickle', 'sharded'], type=str,
+                        help='torch.save file or sharded checkpoint with lazily loaded sections, see checkpoint.py')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
@@ -210,7 +235,8 @@ def main(args):
         global_rank = utils.get_rank()
         if args.repeated_aug:
             sampler_train = RASampler(
-                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
+                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True,
+                num_repeats=args.ra_reps
             )
         else:
             sampler_train = torch.utils.data.DistributedSampler(
@@ -234,6 +260,9 @@ def main(args):
         pin_memory=args.pin_mem, drop_last=False
     )
 
+    # Batched augmentation on the device, the workers only decode and resize (see augment.py).
+    device_aug = DeviceAugment.from_args(args).to(device) if args.device_aug else None
+
     # Initialize the Mixup function if mixup, cutmix, or cutmix_minmax is enabled.
     mixup_fn = None
     mixup_active = args.mixup > 0 or args.cutmix > 0. or args.cutmix_minmax is not None
@@ -255,6 +284,8 @@ def main(args):
         local_up_to_layer=args.local_up_to_layer,
         locality_strength=args.locality_strength,
         embed_dim = args.embed_dim,
+        fused_attn=args.fused_attn,
+        grad_checkpoint=args.grad_checkpoint,
     )
 
     print(model)
@@ -272,15 +303,20 @@ def main(args):
     # Prepare the model for distributed training, if necessary.
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.gpu] if device.type == 'cuda' else None)
         model_without_ddp = model.module
 
+    # Compile the training forward/backward; evaluation and checkpoints use the eager model.
+    train_model = utils.compile_model(model) if args.compile else model
+
     # Calculate the number of trainable parameters in the model and print it.
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
 
     # Calculate the linearly scaled learning rate based on the batch size and world size.
-    linear_scaled_lr = args.lr * args.batch_size * utils.get_world_size() / 512.0
+    # scaled by the effective batch size, accumulated micro-batches included
+    linear_scaled_lr = args.lr * args.batch_size * args.accum_steps * utils.get_world_size() / 512.0
     args.lr = linear_scaled_lr
 
     # Create the optimizer with the updated learning rate and model parameters.
@@ -306,6 +342,8 @@ def main(args):
 
     # Save the arguments to the output directory.
     output_dir = Path(args.output_dir)
+    checkpoint_writer = AsyncCheckpointWriter(
+        keep=args.keep_checkpoints, save_fn=save_sharded if args.checkpoint_format == 'sharded' else torch.save)
     torch.save(args, output_dir / "args.pyT")
 
     # Resume training from a checkpoint if the "resume" argument is specified.
@@ -314,7 +352,8 @@ def main(args):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.resume, map_location='cpu', check_hash=True)
         else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
+            # sharded checkpoints only read the sections used below, --eval only reads 'model'
+            checkpoint = load_checkpoint(args.resume, map_location='cpu')
 
         model_without_ddp.load_state_dict(checkpoint['model'])
         if not args.eval and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
@@ -348,9 +387,11 @@ def main(args):
 
         # Train the model for one epoch.
         train_stats = train_one_epoch(
-            model, criterion, data_loader_train,
+            train_model, criterion, data_loader_train,
             optimizer, device, epoch, loss_scaler,
-            args.clip_grad, model_ema, mixup_fn
+            args.clip_grad, model_ema, mixup_fn,
+            device_aug=device_aug, deferred_sync=args.deferred_sync,
+            accum_steps=args.accum_steps,
         )
 
         # Update the learning rate scheduler for the current epoch.
@@ -358,21 +399,20 @@ def main(args):
 
         # Save the model's progress (checkpoints) to the output directory.
         if args.output_dir:
-            checkpoint_paths = [output_dir / 'checkpoint.pth']
-            # Save additional checkpoints based on the 'save_every' setting.
+            # Save additional checkpoints based on the 'save_every' setting, as hard links.
+            periodic_paths = []
             if args.save_every is not None:
                 if epoch % args.save_every == 0:
-                    checkpoint_paths.append(output_dir / 'checkpoint_{}.pth'.format(epoch))
-            # Save checkpoints to disk.
-            for checkpoint_path in checkpoint_paths:
-                utils.save_on_master({
-                    'model': model_without_ddp.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'lr_scheduler': lr_scheduler.state_dict(),
-                    'epoch': epoch,
-                    'model_ema': get_state_dict(model_ema) if model_ema else None,
-                    'args': args,
-                }, checkpoint_path)
+                    periodic_paths.append(output_dir / 'checkpoint_{}.pth'.format(epoch))
+            # Snapshot the state and write it to disk in the background.
+            checkpoint_writer.save({
+                'model': model_without_ddp.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'epoch': epoch,
+                'model_ema': get_state_dict(model_ema) if model_ema else None,
+                'args': args,
+            }, output_dir / 'checkpoint.pth', periodic_paths)
 
         # Evaluate the model on the validation dataset.
         test_stats = evaluate(data_loader_val, model, device)
@@ -390,6 +430,8 @@ def main(args):
         distances = {}
         batch = next(iter(data_loader_val))[0]
         batch = batch.to(device)
+        if batch.dtype == torch.uint8:
+            batch = normalize(batch)
         batch = model_without_ddp.patch_embed(batch)
         for l in range(len(model_without_ddp.blocks)):
             attn = model_without_ddp.blocks[l].attn
@@ -419,6 +461,9 @@ def main(args):
             with (output_dir / "log.txt").open("a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
+    # Wait for the last checkpoint to be written.
+    checkpoint_writer.wait()
+
     # Calculate the total training time after the training loop.
     total_time = time.time() - start_time
 
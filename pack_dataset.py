@@ -0,0 +1,102 @@
+# Copyright (c) 2015-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the CC-by-NC license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Packs an image folder (one sub-folder per class) into a few large shard files, read back
+with datasets.PackedImageDataset:
+
+    python pack_dataset.py --data-path /path/to/vggface2/train --output-dir /path/to/packed
+
+The output directory contains shard_XXXXX.bin files holding the encoded images back to back,
+index.npz with the shard, offset, length and label of every sample, classes.json with the
+class names and paths.txt with the source path of every sample, relative to --data-path.
+"""
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from torchvision.datasets.folder import DatasetFolder, default_loader
+
+from datasets import IMG_EXTENSIONS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Pack an image folder into shard files")
+    parser.add_argument('--data-path', required=True, type=str, help='image folder to pack')
+    parser.add_argument('--output-dir', required=True, type=str, help='where to write the shards and index')
+    parser.add_argument('--shard-size', default=4., type=float, help='maximum shard size in GB')
+    parser.add_argument('--num-threads', default=16, type=int, help='threads reading the source files')
+    return parser.parse_args()
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_in_order(executor, paths, window):
+    """Contents of paths in order, with at most window reads submitted ahead of the consumer."""
+    pending = deque()
+    for path in paths:
+        pending.append(executor.submit(read_file, path))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def pack(data_path, output_dir, shard_size=4., num_threads=16):
+    folder = DatasetFolder(data_path, loader=default_loader, extensions=IMG_EXTENSIONS)
+    paths = [path for path, _ in folder.samples]
+    num_samples = len(paths)
+    max_shard_bytes = int(shard_size * 2**30)
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    shard_ids = np.zeros(num_samples, dtype=np.int32)
+    offsets = np.zeros(num_samples, dtype=np.int64)
+    lengths = np.zeros(num_samples, dtype=np.int64)
+    labels = np.array([label for _, label in folder.samples], dtype=np.int64)
+
+    shard_id, offset = 0, 0
+    shard = open(output_dir / 'shard_{:05d}.bin'.format(shard_id), 'wb')
+    with ThreadPoolExecutor(num_threads) as executor:
+        # the threads prefetch the next files in order, a bounded number of them so that reads
+        # do not run ahead of a slower writer
+        for i, data in enumerate(read_in_order(executor, paths, 4 * num_threads)):
+            if offset > 0 and offset + len(data) > max_shard_bytes:
+                shard.close()
+                shard_id, offset = shard_id + 1, 0
+                shard = open(output_dir / 'shard_{:05d}.bin'.format(shard_id), 'wb')
+            shard.write(data)
+            shard_ids[i], offsets[i], lengths[i] = shard_id, offset, len(data)
+            offset += len(data)
+            if i % 100000 == 0:
+                print('packed {}/{} images into {} shards'.format(i, num_samples, shard_id + 1))
+    shard.close()
+
+    with open(output_dir / 'classes.json', 'w') as f:
+        json.dump(folder.classes, f)
+    with open(output_dir / 'paths.txt', 'w') as f:
+        for path in paths:
+            f.write(os.path.relpath(path, data_path) + '\n')
+    # written last, a directory without index is an incomplete pack
+    np.savez(output_dir / 'index.npz', shard=shard_ids, offset=offsets, length=lengths, label=labels)
+    print('packed {} images of {} classes into {} shards'.format(num_samples, len(folder.classes), shard_id + 1))
+
+
+def main():
+    args = parse_args()
+    pack(args.data_path, args.output_dir, args.shard_size, args.num_threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,7 @@ class RASampler(torch.utils.data.Sampler):
     Heavily based on torch.utils.data.DistributedSampler
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, num_repeats=3):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -31,7 +31,8 @@ class RASampler(torch.utils.data.Sampler):
         self.num_replicas = num_replicas
         self.rank = rank
         self.epoch = 0
-        self.num_samples = int(math.ceil(len(self.dataset) * 3.0 / self.num_replicas))
+        self.num_repeats = num_repeats
+        self.num_samples = int(math.ceil(len(self.dataset) * float(num_repeats) / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
         # self.num_selected_samples = int(math.ceil(len(self.dataset) / self.num_replicas))
         self.num_selected_samples = int(math.floor(len(self.dataset) // 256 * 256 / self.num_replicas))
@@ -42,23 +43,101 @@ class RASampler(torch.utils.data.Sampler):
         g = torch.Generator()
         g.manual_seed(self.epoch)
         if self.shuffle:
-            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+            indices = torch.randperm(len(self.dataset), generator=g)
         else:
-            indices = list(range(len(self.dataset)))
+            indices = torch.arange(len(self.dataset))
 
         # add extra samples to make it evenly divisible
-        indices = [ele for ele in indices for i in range(3)]
-        indices += indices[:(self.total_size - len(indices))]
+        indices = torch.repeat_interleave(indices, self.num_repeats)
+        indices = torch.cat([indices, indices[:(self.total_size - len(indices))]])
         assert len(indices) == self.total_size
 
         # subsample
         indices = indices[self.rank:self.total_size:self.num_replicas]
         assert len(indices) == self.num_samples
 
-        return iter(indices[:self.num_selected_samples])
+        return iter(indices[:self.num_selected_samples].tolist())
 
     def __len__(self):
         return self.num_selected_samples
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+class PKBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler drawing P identities x K images per batch, for metric learning losses
+    that need positive pairs in every batch. Distributed: batch b goes to process
+    b % num_replicas, each process gets P * K samples per batch.
+
+    Identities are drawn in rounds: each round is a random permutation of the identities cut
+    into groups of P, so an identity appears at most once per batch and once per round. The
+    images of each identity are shuffled once per epoch and consumed K at a time, cycling
+    when an identity has fewer images than needed. An epoch has about len(dataset) / (P * K)
+    batches over all processes.
+    """
+
+    def __init__(self, labels, num_identities, num_instances, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        if num_identities < 1 or num_instances < 1:
+            raise ValueError("P={} identities x K={} instances per batch, both must be at least 1".format(
+                num_identities, num_instances))
+        self.labels = torch.as_tensor(labels, dtype=torch.int64)
+        self.num_identities = num_identities
+        self.num_instances = num_instances
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        # label -> indices, stored CSR-like: the samples of identity i are order[starts[i]:starts[i] + counts[i]]
+        counts = torch.bincount(self.labels)
+        self.identities = torch.nonzero(counts, as_tuple=False).squeeze(1)
+        self.counts = counts
+        self.starts = torch.cumsum(counts, 0) - counts
+        if len(self.identities) < num_identities:
+            raise ValueError("P={} identities per batch but only {} identities in the dataset".format(
+                num_identities, len(self.identities)))
+        self.batches_per_round = len(self.identities) // num_identities
+        total_batches = len(self.labels) // (num_identities * num_instances)
+        self.num_batches = max(total_batches // num_replicas, 1)
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        P, K = self.num_identities, self.num_instances
+        total_batches = self.num_batches * self.num_replicas
+
+        # shuffle the images within each identity: sort by label, ties broken by a random permutation
+        perm = torch.randperm(len(self.labels), generator=g)
+        order = perm[torch.sort(self.labels[perm] * len(self.labels)
+                                + torch.arange(len(self.labels)))[1]]
+
+        # identities of every batch, one permutation per round
+        num_rounds = int(math.ceil(total_batches / self.batches_per_round))
+        rounds = torch.stack([torch.randperm(len(self.identities), generator=g)
+                              for _ in range(num_rounds)])
+        ids = self.identities[rounds[:, :self.batches_per_round * P]]  # rounds x (batches_per_round * P)
+        round_idx = torch.arange(num_rounds).view(-1, 1).expand_as(ids)
+        ids, round_idx = ids.reshape(-1)[:total_batches * P], round_idx.reshape(-1)[:total_batches * P]
+
+        # the j-th image of an identity in round r is its (r * K + j)-th image, modulo its count
+        position = (round_idx.view(-1, 1) * K + torch.arange(K).view(1, -1)) % self.counts[ids].view(-1, 1)
+        indices = order[self.starts[ids].view(-1, 1) + position].view(total_batches, P * K)
+
+        # subsample
+        indices = indices[self.rank::self.num_replicas]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
@@ -2,6 +2,8 @@ import os
 import torch
 from PIL import Image
 from torchvision.datasets import DatasetFolder
+from torchvision.datasets.folder import default_loader
+from torchvision import transforms
 from torchvision.transforms import ToTensor
 
 import torch
@@ -10,6 +12,7 @@ from torch.utils.data import DataLoader
 import torch.nn as nn
 
 from timm.data import create_transform
+from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
 import sys
 
@@ -32,9 +35,12 @@ from timm.scheduler import create_scheduler
 from timm.optim import create_optimizer
 from timm.utils import NativeScaler, get_state_dict, ModelEma
 
-from datasets import build_dataset
-from engine import train_one_epoch, evaluate
-from samplers import RASampler
+from datasets import build_dataset, CachedEvalDataset, PackedImageDataset, SubsampledDatasetFolder
+from engine import train_one_epoch, evaluate_verification
+from losses import CustomContrastiveLoss, EmbeddingMemoryBank
+from checkpoint import AsyncCheckpointWriter, load_checkpoint, save_sharded
+from samplers import PKBatchSampler, RASampler
+from augment import DeviceAugment, build_worker_transform, normalize
 import models
 import utils
 # --------------------------------------------
@@ -58,6 +64,11 @@ def get_args_parser():
                         help='Drop path rate (default: 0.1)')
     parser.add_argument('--drop-block', type=float, default=None, metavar='PCT',
                         help='Drop block rate (default: None)')
+    parser.add_argument('--fused-attn', action='store_true', default=False,
+                        help='Compute attention with torch scaled_dot_product_attention instead of explicit attention maps')
+    parser.add_argument('--grad-checkpoint', type=str, default=None,
+                        help='Recompute block activations in backward to save memory: '
+                             '"all", "gpsa", "mhsa" or k for every k-th block (default: None)')
 
     parser.add_argument('--model-ema', action='store_true')
     parser.add_argument('--no-model-ema', action='store_false', dest='model_ema')
@@ -105,6 +116,17 @@ def get_args_parser():
     parser.add_argument('--decay-rate', '--dr', type=float, default=0.1, metavar='RATE',
                         help='LR decay rate (default: 0.1)')
 
+    # Contrastive loss parameters
+    parser.add_argument('--margin', type=float, default=1.0, help='margin of the negative pairs (default: 1.0)')
+    parser.add_argument('--loss-chunk-size', type=int, default=1024,
+                        help='rows of the pairwise distance matrix computed at once (default: 1024)')
+    parser.add_argument('--gather-negatives', action='store_true',
+                        help='compute the contrastive loss on the batch gathered from all processes')
+    parser.add_argument('--memory-bank-size', type=int, default=0,
+                        help='embeddings of previous batches kept as extra pairs (default: 0, disabled)')
+    parser.add_argument('--hard-negatives', type=int, default=0,
+                        help='hardest negatives kept per anchor, 0 to average over all negatives (default: 0)')
+
     # Augmentation parameters
     parser.add_argument('--color-jitter', type=float, default=0.4, metavar='PCT',
                         help='Color jitter factor (default: 0.4)')
@@ -115,9 +137,21 @@ def get_args_parser():
     parser.add_argument('--train-interpolation', type=str, default='bicubic',
                         help='Training interpolation (random, bilinear, bicubic default: "bicubic")')
 
+    parser.add_argument('--deferred-sync', action='store_true',
+                        help='copy the training losses to the host every print_freq steps instead of every step')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='train with torch.compile (torch>=2.0), static shapes; evaluation stays eager')
+    parser.add_argument('--accum-steps', default=1, type=int,
+                        help='batches whose gradients are accumulated (without all-reduce) before each optimizer step')
+    parser.add_argument('--device-aug', action='store_true', default=False,
+                        help='Workers only decode and resize, crop/flip/color jitter/random erasing run batched on the device')
     parser.add_argument('--repeated-aug', action='store_true')
     parser.add_argument('--no-repeated-aug', action='store_false', dest='repeated_aug')
     parser.set_defaults(repeated_aug=True)
+    parser.add_argument('--ra-reps', default=3, type=int, help='number of repetitions of each sample with --repeated-aug')
+    parser.add_argument('--pk-sampler', action='store_true',
+                        help='batches of batch_size / K identities x K images, see samplers.PKBatchSampler')
+    parser.add_argument('--pk-instances', default=4, type=int, help='K, images per identity with --pk-sampler')
 
     # * Random Erase params
     parser.add_argument('--reprob', type=float, default=0.25, metavar='PCT',
@@ -146,12 +180,18 @@ def get_args_parser():
     # Dataset parameters
     parser.add_argument('--data-path', default='/datasets01/imagenet_full_size/061417/', type=str,
                         help='dataset path')
+    parser.add_argument('--data-format', default='folder', choices=['folder', 'packed'],
+                        type=str, help='image folder, or shards written by pack_dataset.py')
     parser.add_argument('--data-set', default='IMNET', choices=['CIFAR10', 'CIFAR100', 'IMNET', 'INAT', 'INAT19'],
                         type=str, help='Image Net dataset path')
     parser.add_argument('--sampling_ratio', default=1.,
                         type=float, help='fraction of samples to keep in the training set of imagenet')
     parser.add_argument('--nb_classes', default=None,
                         type=int, help='number of classes in imagenet')
+    parser.add_argument('--index-cache-dir', default=os.path.expanduser('~/.cache/convit'), type=str,
+                        help='where to cache the file index of image folders, empty to disable')
+    parser.add_argument('--eval-cache-dir', default='', type=str,
+                        help='cache the preprocessed validation images in this directory (default: disabled)')
     parser.add_argument('--inat-category', default='name',
                         choices=['kingdom', 'phylum', 'class', 'order', 'supercategory', 'family', 'genus', 'name'],
                         type=str, help='semantic granularity')
@@ -163,6 +203,10 @@ def get_args_parser():
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--save_every', default=None, type=int, help='save model every epochs')
+    parser.add_argument('--keep-checkpoints', default=None, type=int,
+                        help='number of checkpoint_<epoch>.pth files to keep, at least 1 (default: all)')
+    parser.add_argument('--checkpoint-format', default='pickle', choices=['pickle', 'sharded'], type=str,
+                        help='torch.save file or sharded checkpoint with lazily loaded sections, see checkpoint.py')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
@@ -191,18 +235,21 @@ def get_args_parser():
     # evealuation parameters
     parser.add_argument('--eval_every_x_epochs', default=1, type=int,
                         help='Evaluate every x epochs')
+    parser.add_argument('--verification-chunk-size', default=None, type=int,
+                        help='rows of the similarity matrix per chunk in evaluation (default: fit in 1GB)')
     
     return parser
 
-class VGGFace2Dataset(datasets.DatasetFolder):
-    def __init__(self, root, transform=None, target_transform=None):
+class VGGFace2Dataset(SubsampledDatasetFolder):
+    def __init__(self, root, transform=None, target_transform=None, index_cache_dir=None):
         super(VGGFace2Dataset, self).__init__(
             root,
-            loader=datasets.folder.default_loader,  # Use the default image loader
+            loader=default_loader,  # Use the default image loader
             extensions=('jpg', 'jpeg', 'png'),     # Accept jpg, jpeg, and png image files
             transform=transform,
             target_transform=target_transform,
-            is_valid_file=None
+            is_valid_file=None,
+            index_cache_dir=index_cache_dir  # file index cached across runs, see datasets.load_subsampled_dataset
         )
 
 
@@ -222,6 +269,9 @@ def build_transform(is_train, args):
         transform (callable): The transform.
     """
     resize_im = args.input_size > 32
+    if is_train and args.device_aug:
+        # crop, flip, color jitter and random erasing run batched on the device, see augment.py
+        return build_worker_transform(args)
     if is_train:
         # this should always dispatch to transforms_imagenet_train
         transform = create_transform(
@@ -241,32 +291,18 @@ def build_transform(is_train, args):
                 args.input_size, padding=4)
         return transform
 
-
-class CustomContrastiveLoss(nn.Module):
-    """/!\ placeholder for a custom loss function
-
-    Args:
-        nn (module): PyTorch module
-    """
-    def __init__(self, margin):
-        super(CustomContrastiveLoss, self).__init__()
-        self.margin = margin
-
-    def forward(self, feature_vectors, labels):
-        pairwise_distances = torch.cdist(feature_vectors, feature_vectors)
-        label_matrix = labels.view(-1, 1) == labels.view(1, -1)
-
-        # Loss for positive pairs (same person)
-        positive_distances = pairwise_distances * label_matrix.float()
-        positive_loss = torch.sum(positive_distances) / (torch.sum(label_matrix) - len(labels))
-
-        # Loss for negative pairs (different people)
-        negative_distances = pairwise_distances * (~label_matrix).float()
-        negative_loss = torch.sum(torch.clamp(self.margin - negative_distances, min=0)) / torch.sum(~label_matrix)
-
-        # Total loss
-        loss = positive_loss + negative_loss
-        return loss
+    t = []
+    if resize_im:
+        size = int((256 / 224) * args.input_size)
+        t.append(transforms.Resize(size, interpolation=3))
+        t.append(transforms.CenterCrop(args.input_size))
+    if args.eval_cache_dir:
+        # uint8 images for CachedEvalDataset, normalized on the device by engine.evaluate
+        t.append(transforms.PILToTensor())
+        return transforms.Compose(t)
+    t.append(transforms.ToTensor())
+    t.append(transforms.Normalize(IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD))
+    return transforms.Compose(t)
 
 
 def main(args):
@@ -293,17 +329,35 @@ def main(args):
     transform_train = build_transform(True, args)
     transform_val = build_transform(False, args)
     
-    dataset_train = VGGFace2Dataset(args.data_path, transform=transform_train)
-    dataset_val = VGGFace2Dataset(args.data_path, transform=transform_val)
+    if args.data_format == 'packed':
+        dataset_train = PackedImageDataset(args.data_path, transform=transform_train)
+        dataset_val = PackedImageDataset(args.data_path, transform=transform_val)
+    else:
+        dataset_train = VGGFace2Dataset(args.data_path, transform=transform_train,
+                                        index_cache_dir=args.index_cache_dir or None)
+        dataset_val = VGGFace2Dataset(args.data_path, transform=transform_val,
+                                      index_cache_dir=args.index_cache_dir or None)
+    if args.eval_cache_dir:
+        # decoded once on the first evaluation, then read back from a memory-mapped file
+        dataset_val = CachedEvalDataset(dataset_val, args.eval_cache_dir, args.input_size)
     # Set up the sampler for distributed training, which ensures that each process receives
     # different data samples during training. Use the Random Augmented Sampler if the
     # "repeated_aug" argument is set to True, otherwise use the Distributed Sampler.
     if True:  # args.distributed:
         num_tasks = utils.get_world_size()
         global_rank = utils.get_rank()
-        if args.repeated_aug:
+        if args.pk_sampler:
+            if args.batch_size < args.pk_instances or args.batch_size % args.pk_instances != 0:
+                raise ValueError("--batch-size {} must be a multiple of --pk-instances {}".format(
+                    args.batch_size, args.pk_instances))
+            sampler_train = PKBatchSampler(
+                dataset_train.targets, args.batch_size // args.pk_instances, args.pk_instances,
+                num_replicas=num_tasks, rank=global_rank, seed=args.seed
+            )
+        elif args.repeated_aug:
             sampler_train = RASampler(
-                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
+                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True,
+                num_repeats=args.ra_reps
             )
         else:
             sampler_train = torch.utils.data.DistributedSampler(
@@ -313,13 +367,20 @@ def main(args):
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
     
     # Create the data loaders for the training and validation datasets.
-    data_loader_train = torch.utils.data.DataLoader(
-        dataset_train, sampler=sampler_train,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_mem,
-        drop_last=True,
-    )
+    if args.pk_sampler:
+        data_loader_train = torch.utils.data.DataLoader(
+            dataset_train, batch_sampler=sampler_train,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+        )
+    else:
+        data_loader_train = torch.utils.data.DataLoader(
+            dataset_train, sampler=sampler_train,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=True,
+        )
     
     data_loader_val = torch.utils.data.DataLoader(
         dataset_val, batch_size=int(1.5 * args.batch_size),
@@ -327,6 +388,9 @@ def main(args):
         pin_memory=args.pin_mem, drop_last=False
     )
     
+    # Batched augmentation on the device, the workers only decode and resize (see augment.py).
+    device_aug = DeviceAugment.from_args(args).to(device) if args.device_aug else None
+
     # Initialize the Mixup function if mixup, cutmix, or cutmix_minmax is enabled.
     mixup_fn = None
     mixup_active = args.mixup > 0 or args.cutmix > 0. or args.cutmix_minmax is not None
@@ -348,6 +412,8 @@ def main(args):
         local_up_to_layer=args.local_up_to_layer,
         locality_strength=args.locality_strength,
         embed_dim = args.embed_dim,
+        fused_attn=args.fused_attn,
+        grad_checkpoint=args.grad_checkpoint,
     )
     
     print(model)
@@ -366,15 +432,20 @@ def main(args):
     # Prepare the model for distributed training, if necessary.
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.gpu] if device.type == 'cuda' else None)
         model_without_ddp = model.module
+
+    # Compile the training forward/backward; evaluation and checkpoints use the eager model.
+    train_model = utils.compile_model(model) if args.compile else model
     
     # Calculate the number of trainable parameters in the model and print it.
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
     
     # Calculate the linearly scaled learning rate based on the batch size and world size.
-    linear_scaled_lr = args.lr * args.batch_size * utils.get_world_size() / 512.0
+    # scaled by the effective batch size, accumulated micro-batches included
+    linear_scaled_lr = args.lr * args.batch_size * args.accum_steps * utils.get_world_size() / 512.0
     args.lr = linear_scaled_lr
     
     # Create the optimizer with the updated learning rate and model parameters.
@@ -388,10 +459,18 @@ def main(args):
     
     # Set up the loss function (criterion) for training. Use SoftTargetCrossEntropy if mixup is enabled,
     # LabelSmoothingCrossEntropy if label smoothing is enabled, or CrossEntropyLoss otherwise.
-    criterion = CustomContrastiveLoss()
+    memory_bank = None
+    if args.memory_bank_size > 0:
+        memory_bank = EmbeddingMemoryBank(
+            args.memory_bank_size, model_without_ddp.num_classes or model_without_ddp.num_features).to(device)
+    criterion = CustomContrastiveLoss(args.margin, chunk_size=args.loss_chunk_size,
+                                      gather=args.gather_negatives, memory_bank=memory_bank,
+                                      hard_negatives=args.hard_negatives)
     
     # Save the arguments to the output directory.
     output_dir = Path(args.output_dir)
+    checkpoint_writer = AsyncCheckpointWriter(
+        keep=args.keep_checkpoints, save_fn=save_sharded if args.checkpoint_format == 'sharded' else torch.save)
     torch.save(args, output_dir / "args.pyT")
     
     # Resume training from a checkpoint if the "resume" argument is specified.
@@ -400,7 +479,8 @@ def main(args):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.resume, map_location='cpu', check_hash=True)
         else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
+            # sharded checkpoints only read the sections used below, --eval only reads 'model'
+            checkpoint = load_checkpoint(args.resume, map_location='cpu')
 
         model_without_ddp.load_state_dict(checkpoint['model'])
         if not args.eval and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
@@ -409,14 +489,16 @@ def main(args):
             args.start_epoch = checkpoint['epoch'] + 1
             if args.model_ema:
                 utils._load_checkpoint_for_ema(model_ema, checkpoint['model_ema'])
+            if memory_bank is not None and checkpoint.get('memory_bank') is not None:
+                memory_bank.load_state_dict(checkpoint['memory_bank'])
     
     # If the "eval" argument is set to True, evaluate the model on the validation dataset and return.
-    # /!\ this part needs checking
     if args.eval:
         throughput = utils.compute_throughput(model, resolution=args.input_size)
         print(f"Throughput : {throughput:.2f}")
-        test_stats = evaluate(data_loader_val, model, device)
-        print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
+        test_stats = evaluate_verification(data_loader_val, model, device,
+                                           chunk_size=args.verification_chunk_size)
+        print(f"Rank-1 identification on the {len(dataset_val)} test images: {test_stats['rank1']:.1f}%")
         return
     
     
@@ -432,14 +514,16 @@ def main(args):
         gc.collect()
         
         # If using distributed training, set the current epoch for the sampler.
-        if args.distributed:
-            data_loader_train.sampler.set_epoch(epoch)
+        if args.distributed or args.pk_sampler:
+            sampler_train.set_epoch(epoch)
         
         # Train the model for one epoch.
         train_stats = train_one_epoch(
-            model, criterion, data_loader_train,
+            train_model, criterion, data_loader_train,
             optimizer, device, epoch, loss_scaler,
-            args.clip_grad, model_ema, mixup_fn
+            args.clip_grad, model_ema, mixup_fn,
+            device_aug=device_aug, deferred_sync=args.deferred_sync,
+            accum_steps=args.accum_steps,
         )
         
         # Update the learning rate scheduler for the current epoch.
@@ -447,33 +531,35 @@ def main(args):
         
         # Save the model's progress (checkpoints) to the output directory.
         if args.output_dir:
-            checkpoint_paths = [output_dir / 'checkpoint.pth']
-            # Save additional checkpoints based on the 'save_every' setting.
+            # Save additional checkpoints based on the 'save_every' setting, as hard links.
+            periodic_paths = []
             if args.save_every is not None:
                 if epoch % args.save_every == 0:
-                    checkpoint_paths.append(output_dir / 'checkpoint_{}.pth'.format(epoch))
-            # Save checkpoints to disk.
-            for checkpoint_path in checkpoint_paths:
-                utils.save_on_master({
-                    'model': model_without_ddp.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'lr_scheduler': lr_scheduler.state_dict(),
-                    'epoch': epoch,
-                    'model_ema': get_state_dict(model_ema) if model_ema else None,
-                    'args': args,
-                }, checkpoint_path)
+                    periodic_paths.append(output_dir / 'checkpoint_{}.pth'.format(epoch))
+            # Snapshot the state and write it to disk in the background.
+            checkpoint_writer.save({
+                'model': model_without_ddp.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'epoch': epoch,
+                'model_ema': get_state_dict(model_ema) if model_ema else None,
+                'memory_bank': memory_bank.state_dict() if memory_bank is not None else None,
+                'args': args,
+            }, output_dir / 'checkpoint.pth', periodic_paths)
         
-        if epoch % args.eval_every == 0 or epoch == args.epochs - 1:
+        test_stats = {}
+        if epoch % args.eval_every_x_epochs == 0 or epoch == args.epochs - 1:
             
             print("Start validation")
             # Evaluate the model on the validation dataset.
-            test_stats = evaluate(data_loader_val, model, device)
+            test_stats = evaluate_verification(data_loader_val, model, device,
+                                               chunk_size=args.verification_chunk_size)
             
-            # Print the model's accuracy on the validation dataset.
-            print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
+            # Print the model's identification accuracy on the validation dataset.
+            print(f"Rank-1 identification on the {len(dataset_val)} test images: {test_stats['rank1']:.1f}%")
 
             # Update the maximum accuracy achieved so far.
-            max_accuracy = max(max_accuracy, test_stats["acc1"])
+            max_accuracy = max(max_accuracy, test_stats["rank1"])
             print(f'Max accuracy: {max_accuracy:.2f}%')
             print("End validation")
             
@@ -483,6 +569,8 @@ def main(args):
         distances = {}
         batch = next(iter(data_loader_val))[0]
         batch = batch.to(device)
+        if batch.dtype == torch.uint8:
+            batch = normalize(batch)
         batch = model_without_ddp.patch_embed(batch)
         for l in range(len(model_without_ddp.blocks)):
             attn = model_without_ddp.blocks[l].attn
@@ -496,6 +584,14 @@ def main(args):
                 distances[l] = dist.cpu().numpy().tolist()
                 gating_params[l] = attn.gating_param.data.cpu().numpy().tolist()
 
+        # Gather all the statistics into a single dictionary, without test stats on epochs without validation.
+        log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                    **{f'test_{k}': v for k, v in test_stats.items()},
+                    **{f'nonlocality_{k}': v for k, v in nonlocality.items()},
+                    **{f'distances_{k}': v for k, v in distances.items()},
+                    **{f'gating_params_{k}': v for k, v in gating_params.items()},
+                    'epoch': epoch,'n_parameters': n_parameters}
+
         # Print the collected statistics.
         print(log_stats)
 
@@ -513,6 +609,9 @@ def main(args):
         # Print the total training time.
         print('Training time {}'.format(total_time_str))
         
+    # Wait for the last checkpoint to be written.
+    checkpoint_writer.wait()
+
     # Calculate the total training time after the training loop.
     total_time = time.time() - start_time
 
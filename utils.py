@@ -45,7 +45,8 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -226,7 +227,7 @@ def init_distributed_mode(args):
         args.gpu = int(os.environ['LOCAL_RANK'])
     elif 'SLURM_PROCID' in os.environ:
         args.rank = int(os.environ['SLURM_PROCID'])
-        args.gpu = args.rank % torch.cuda.device_count()
+        args.gpu = args.rank % max(torch.cuda.device_count(), 1)
     else:
         print('Not using distributed mode')
         args.distributed = False
@@ -234,8 +235,12 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        # CPU-only processes, e.g. several local ones launched with torch.distributed.launch
+        args.dist_backend = 'gloo'
     print('| distributed init (rank {}): {}'.format(
         args.rank, args.dist_url), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
@@ -243,6 +248,52 @@ def init_distributed_mode(args):
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
 
+class _CompiledModel(torch.nn.Module):
+    """Runs the compiled model, or the eager one from then on if the first compiled call fails
+    (no inductor backend or C compiler for instance). Other attributes, such as no_sync of
+    DistributedDataParallel, are those of the eager model.
+    """
+    def __init__(self, compiled, eager):
+        super(_CompiledModel, self).__init__()
+        self.compiled = compiled
+        self.eager = eager
+        self.checked = False
+
+    def forward(self, *args, **kwargs):
+        if self.checked:
+            return self.compiled(*args, **kwargs)
+        try:
+            output = self.compiled(*args, **kwargs)
+        except Exception as e:
+            print('torch.compile failed ({}: {}), running eagerly'.format(type(e).__name__, str(e).split('\n')[0]))
+            self.compiled = self.eager
+            output = self.eager(*args, **kwargs)
+        self.checked = True
+        return output
+
+    def __getattr__(self, name):
+        try:
+            return super(_CompiledModel, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.eager, name)
+
+
+def compile_model(model):
+    """torch.compile(model) with static shapes when this torch version has it, the model
+    itself otherwise. The GPSA relative indices are built beforehand, so the compiled graph
+    does not rebuild them; an input resolution change still recompiles, and torch falls back
+    to eager execution past its recompilation limit. If compilation fails on the first call,
+    the model runs eagerly.
+    """
+    if not hasattr(torch, 'compile'):
+        print('torch.compile is not available in torch {}, running eagerly'.format(torch.__version__))
+        return model
+    module = model.module if hasattr(model, 'module') else model
+    if hasattr(module, 'build_rel_indices'):
+        module.build_rel_indices()
+    return _CompiledModel(torch.compile(model, dynamic=False), model)
+
+
 @torch.no_grad()
 def compute_throughput(model, batch_size=128, resolution=224):
     torch.cuda.empty_cache()